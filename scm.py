@@ -3,13 +3,34 @@
 A Little Scheme in Python 2.7/3.8, v3.2 H31.01.13/R02.04.09 by SUZUKI Hisao
 """
 from __future__ import print_function
-from sys import argv, exit
+from sys import argv, byteorder, exit, stderr, stdin, stdout
+from time import sleep, time
+import atexit
+from importlib import import_module
+from itertools import chain, count, islice, repeat, starmap
+from array import array
+from collections import deque
+from codecs import getincrementaldecoder
+import gc
+import os
+from types import CodeType, FunctionType
+from struct import Struct
+from bisect import bisect_left
 try:
     from sys import intern      # for Python 3
     raw_input = input           # for Python 3
     long = int                  # for Python 3
+    unicode = str               # for Python 3
 except ImportError:
     pass
+try:
+    from StringIO import StringIO # for Python 2
+    from itertools import imap  # for Python 2
+    from thread import _local as local # for Python 2
+except ImportError:
+    from io import StringIO
+    imap = map
+    from _thread import _local as local # threading.local without threading
 
 class List (object):
     "Empty list"
@@ -53,6 +74,7 @@ DEFINE = intern('define')
 SETQ = intern('set!')
 APPLY = intern('apply')
 CALLCC = intern('call/cc')
+CHECKPOINT = intern('checkpoint')
 
 NOCONT = ()                   # NOCONT means there is no continuation.
 # Continuation operators
@@ -61,6 +83,7 @@ APPLY_FUN = intern('aplly-fun')
 EVAL_ARG = intern('eval-arg')
 CONS_ARGS = intern('cons-args')
 RESTORE_ENV = intern('restore-env')
+RESUME = intern('resume')
 
 class ApplyClass:
     def __str__(self):
@@ -70,8 +93,13 @@ class CallCcClass:
     def __str__(self):
         return '#<call/cc>'
 
+class CheckpointClass:
+    def __str__(self):
+        return '#<checkpoint>'
+
 APPLY_OBJ = ApplyClass()
 CALLCC_OBJ = CallCcClass()
+CHECKPOINT_OBJ = CheckpointClass()
 
 class SchemeString:
     "String in Scheme"
@@ -87,7 +115,9 @@ class Environment (object):
     __slots__ = ('sym', 'val', 'next')
 
     def __init__(self, sym, val, next):
-        "(env.sym is None) means the env is the frame top. "
+        """(env.sym is None) means the env is the frame top.
+        Then env.val is the top-level env, or None if env is the top-level.
+        """
         self.sym, self.val, self.next = sym, val, next
 
     def __iter__(self):
@@ -99,29 +129,171 @@ class Environment (object):
 
     def look_for(self, symbol):
         "Search the bindings for a symbol."
-        for env in self:
+        env = self
+        while env is not None:
             if env.sym is symbol:
+                if env.__class__ is Boxed:
+                    return env.val
                 return env
+            env = env.next
         raise NameError(symbol)
 
-    def prepend_defs(self, symbols, data):
-        "Build an environment prepending the bindings of symbols and data."
-        if symbols is NIL:
-            if data is not NIL:
-                raise TypeError('surplus arg: ' + stringify(data))
-            return self
-        else:
+    def prepend_defs(self, symbols, data, boxes=()):
+        """Build an environment prepending the bindings of symbols and data.
+        The symbols in boxes are bound through Boxes.  Those of them not
+        in symbols are bound to Boxes of None for later internal defines.
+        """
+        top = env = Environment(None, None, None)
+        n = 0
+        while symbols is not NIL:
             if data is NIL:
-                raise TypeError('surplus param: ' + stringify(symbols))
-            return Environment(symbols.car, data.car,
-                               self.prepend_defs(symbols.cdr, data.cdr))
+                raise TypeError('surplus param: ' + _abbreviate(symbols))
+            sym = symbols.car
+            if boxes and sym in boxes:
+                env.next = Boxed(sym, Box(data.car), None)
+                n += 1
+            else:
+                env.next = Environment(sym, data.car, None)
+            env, symbols, data = env.next, symbols.cdr, data.cdr
+        if data is not NIL:
+            raise TypeError('surplus arg: ' + _abbreviate(data))
+        env.next = self
+        if n < len(boxes):
+            params, j = set(), top.next
+            while j is not self:
+                params.add(j.sym)
+                j = j.next
+            for sym in boxes:
+                if sym not in params:
+                    top.next = Boxed(sym, Box(None), top.next)
+        return top.next
+
+class Boxed (Environment):
+    "Binding whose value is held in a Box shared with closures"
+    __slots__ = ()
+
+class Box (object):
+    "Mutable value of a variable captured by closures and assigned"
+    __slots__ = ('val',)
+
+    def __init__(self, val):
+        self.val = val
+
+    def __repr__(self):
+        return '#<box>'
 
 class Closure (object):
     "Lambda expression with its environment"
-    __slots__ = ('params', 'body', 'env')
+    __slots__ = ('params', 'body', 'env', 'info')
 
-    def __init__(self, params, body, env):
+    def __init__(self, params, body, env, info=None):
         self.params, self.body, self.env = params, body, env
+        self.info = info        # LambdaInfo of the lambda expression
+
+class LambdaInfo (object):
+    """Result of the analysis of a lambda expression
+    It replaces the symbol lambda of the expression once analyzed.
+    """
+    __slots__ = ('free', 'sets', 'boxes', 'calls', 'jit')
+
+    def __init__(self, free, sets, boxes):
+        self.free = free        # frozenset of free variables
+        self.sets = sets        # free variables assigned by set!
+        self.boxes = boxes      # local variables to be bound through Boxes
+        self.calls = 0          # the number of calls interpreted
+        self.jit = None         # compiled function, False if not compilable
+
+    def __str__(self):
+        return 'lambda'
+
+def _analyze(lam):
+    """Analyze a lambda expression (lambda (v...) e...) and the lambda
+    expressions in it.  Replace their cars with LambdaInfos.
+    """
+    j = lam.cdr.cdr
+    while isinstance(j, Cell):  # Expand the macro uses in the body first.
+        expand(j.car)
+        j = j.cdr
+    params = set()
+    j = lam.cdr.car
+    while isinstance(j, Cell):
+        params.add(j.car)
+        j = j.cdr
+    refs, sets, defs, captured, inner_sets = set(), set(), set(), set(), set()
+    stack = [lam.cdr.cdr]       # Walk the body without recursion.
+    while stack:
+        exp = stack.pop()
+        if isinstance(exp, str):
+            refs.add(exp)
+        elif isinstance(exp, Cell):
+            kar = exp.car
+            if kar is QUOTE:
+                pass
+            elif kar is LAMBDA or kar.__class__ is LambdaInfo:
+                info = _analyze(exp) if kar is LAMBDA else kar
+                captured |= info.free
+                inner_sets |= info.sets
+            elif kar is DEFINE or kar is SETQ:
+                v = exp.cdr.car
+                if isinstance(v, str):
+                    (defs if kar is DEFINE else sets).add(v)
+                    refs.add(v)
+                if isinstance(exp.cdr.cdr, Cell):
+                    stack.append(exp.cdr.cdr.car)
+            else:
+                if kar is not IF and kar is not BEGIN:
+                    stack.append(kar)
+                j = exp.cdr
+                while isinstance(j, Cell):
+                    stack.append(j.car)
+                    j = j.cdr
+    local = params | defs
+    sets |= inner_sets
+    boxes = frozenset(v for v in captured & local if v in sets or v in defs)
+    info = LambdaInfo(frozenset((refs | captured) - local),
+                      frozenset(sets - local), boxes)
+    lam.car = info
+    return info
+
+def _make_closure(exp, env):
+    """Make a closure of (lambda (v...) e...) with a flat environment
+    which holds the bindings of its free variables only.
+    """
+    info = exp.car
+    if info is LAMBDA:
+        info = _analyze(exp)
+    free, captured = info.free, None
+    j = env
+    while j is not None and not (j.sym is None and j.val is None):
+        sym = j.sym             # Collect the bindings of free variables
+        if sym in free:         # up to the top-level environment.
+            if captured is None:
+                captured = {}
+            if sym not in captured:
+                captured[sym] = j
+        j = j.next
+    top = j
+    if captured is None:
+        e = top
+    else:
+        e = top
+        for sym, b in captured.items(): # Copy each binding or share its box.
+            e = (Boxed if b.__class__ is Boxed else Environment)(sym, b.val, e)
+        e = Environment(None, top, e) # marker of the frame top
+    kdr = exp.cdr
+    return Closure(kdr.car, kdr.cdr, e, info)
+
+def _define(env, sym, val):
+    "Define sym as val in the frame of env."
+    assert env.sym is None      # Check for the marker.
+    if env.val is not None:     # unless env is the top-level...
+        j = env.next
+        while j.sym is not None:
+            if j.sym is sym and j.__class__ is Boxed:
+                j.val.val = val
+                return
+            j = j.next
+    env.next = Environment(sym, val, env.next)
 
 class Intrinsic (object):
     "Built-in function"
@@ -133,25 +305,133 @@ class Intrinsic (object):
     def __repr__(self):
         return '#<%s:%d>' % (self.name, self.arity)
 
+class Continuable (Intrinsic):
+    """Built-in function which may call Scheme functions
+    Its fun returns either the result or a Call to be made before it.
+    """
+    __slots__ = ()
+
+class Call (object):
+    """Request of a Continuable to call fun with args and then to call
+    step(result, state), which returns again either the result or a Call.
+    The state should not be mutated so that continuations can be resumed
+    any number of times.
+    """
+    __slots__ = ('fun', 'args', 'step', 'state')
+
+    def __init__(self, fun, args, step, state):
+        self.fun, self.args, self.step, self.state = fun, args, step, state
+
+    def __repr__(self):
+        return '#<call %s>' % self.step.__name__
+
+# Items of the work stack in stringify
+_VALUE, _TEXT, _REST = 0, 1, 2
+
 def stringify(exp, quote=True):
     "Convert an expression to a string."
+    if not isinstance(exp, (Cell, Closure, tuple, Record)):
+        return _stringify_atom(exp, quote)
+    ss = []
+    stack = [(_VALUE, exp, quote)] # Use a stack instead of recursion.
+    while stack:
+        tag, exp, q = stack.pop()
+        if tag is _TEXT:
+            ss.append(exp)
+        elif tag is _REST:    # exp = the rest of a list being printed
+            while (isinstance(exp, Cell) and
+                   not isinstance(exp.car, (Cell, Closure, tuple, Record))):
+                ss.append(' ')
+                ss.append(_stringify_atom(exp.car, q))
+                exp = exp.cdr
+            if isinstance(exp, Cell):
+                ss.append(' ')
+                stack.append((_REST, exp.cdr, q))
+                stack.append((_VALUE, exp.car, q))
+            elif exp is NIL:
+                ss.append(')')
+            else:
+                ss.append(' . ')
+                stack.append((_TEXT, ')', q))
+                stack.append((_VALUE, exp, q))
+        elif isinstance(exp, Cell):
+            ss.append('(')
+            stack.append((_REST, exp.cdr, q))
+            stack.append((_VALUE, exp.car, q))
+        elif isinstance(exp, Closure):
+            ss.append('#<')
+            stack.extend(((_TEXT, '>', True), (_VALUE, exp.env, True),
+                          (_TEXT, ':', True), (_VALUE, exp.body, True),
+                          (_TEXT, ':', True), (_VALUE, exp.params, True)))
+        elif isinstance(exp, Record):
+            ss.append('#<' + exp.name)
+            stack.append((_TEXT, '>', q))
+            for f, s in reversed(tuple(zip(exp.fields, exp.__slots__))):
+                stack.append((_VALUE, getattr(exp, s), q))
+                stack.append((_TEXT, ' %s=' % f, q))
+        elif isinstance(exp, tuple) and len(exp) == 3:
+            ss.append('#<')
+            stack.extend(((_TEXT, '>', True), (_VALUE, exp[2], True),
+                          (_TEXT, ':\n ', True), (_VALUE, exp[1], True),
+                          (_TEXT, ':', True), (_VALUE, exp[0], True)))
+        else:
+            ss.append(_stringify_atom(exp, q))
+    return ''.join(ss)
+
+def _stringify_atom(exp, quote):
+    "Convert an expression other than a pair, a closure or a continuation."
     if exp is True:
         return '#t'
     elif exp is False:
         return '#f'
-    elif isinstance(exp, List):
+    elif exp is NIL:
+        return '()'
+    elif isinstance(exp, Environment):
         ss = []
-        try:
-            for element in exp:
-                ss.append(stringify(element, quote))
-        except ImproperListError as ex:
-            ss.append('.')
-            ss.append(stringify(ex.args[0], quote))
+        for env in exp:
+            if env.sym is None and env.val is None: # the top-level
+                ss.append('GlobalEnv')
+                break
+            elif env.sym is None: # marker of the frame top
+                ss.append('|')
+            else:
+                ss.append(env.sym)
+        return '#<' + ' '.join(ss) + '>'
+    elif isinstance(exp, SchemeString) and not quote:
+        return exp.string
+    elif isinstance(exp, _BYTEVECTORS):
+        return '#u8(%s)' % ' '.join(str(b) for b in bytearray(_view(exp)))
+    elif isinstance(exp, type) and issubclass(exp, Record):
+        return '#<record-type %s>' % exp.name
+    else:
+        return str(exp)
+
+def _abbreviate(exp, level=3, length=8):
+    """Convert an expression to a string as stringify does, but show
+    at most length elements of each list and level levels of nesting.
+    """
+    if isinstance(exp, Cell):
+        if level == 0:
+            return '(...)'
+        ss, j = [], exp
+        while isinstance(j, Cell):
+            if len(ss) == length:
+                ss.append('...')
+                break
+            ss.append(_abbreviate(j.car, level - 1, length))
+            j = j.cdr
+        else:
+            if j is not NIL:
+                ss.append('.')
+                ss.append(_abbreviate(j, level - 1, length))
         return '(' + ' '.join(ss) + ')'
     elif isinstance(exp, Environment):
         ss = []
         for env in exp:
-            if env is GLOBAL_ENV:
+            if len(ss) == length:
+                ss.append('...')
+                break
+            elif env.sym is None and env.val is None: # the top-level
                 ss.append('GlobalEnv')
                 break
             elif env.sym is None: # marker of the frame top
@@ -160,19 +440,29 @@ def stringify(exp, quote=True):
                 ss.append(env.sym)
         return '#<' + ' '.join(ss) + '>'
     elif isinstance(exp, Closure):
-        p, b, e = [stringify(x) for x in (exp.params, exp.body, exp.env)]
+        p, b, e = [_abbreviate(x, level, length)
+                   for x in (exp.params, exp.body, exp.env)]
         return '#<' + p + ':' + b + ':' + e + '>'
+    elif isinstance(exp, Record):
+        ss = ['#<' + exp.name]
+        for f, s in zip(exp.fields, exp.__slots__):
+            if len(ss) > length:
+                ss.append('...')
+                break
+            ss.append('%s=%s' % (f, _abbreviate(getattr(exp, s), level - 1,
+                                                length)))
+        return ' '.join(ss) + '>'
+    elif isinstance(exp, _BYTEVECTORS) and len(exp) > length:
+        return '#u8(%s ...)' % ' '.join(
+            str(b) for b in bytearray(_view(exp)[:length]))
     elif isinstance(exp, tuple) and len(exp) == 3:
-        p, v, k = [stringify(x) for x in exp]
-        return '#<' + p + ':' + v + ':\n ' + k + '>'
-    elif isinstance(exp, SchemeString) and not quote:
-        return exp.string
+        return '#<continuation>'
     else:
-        return str(exp)
+        return stringify(exp)
 
 def _globals(x):
     "Return a list of keys of the global environment."
-    j, env = NIL, GLOBAL_ENV.next # Take next to skip the marker.
+    j, env = NIL, TOP_LEVEL.env.next # Take next to skip the marker.
     for e in env:
         j = Cell(e.sym, j)
     return j
@@ -185,7 +475,1046 @@ def _error(x):
 class ErrorException (Exception):
     pass
 
+class EvaluationError (Exception):
+    """Exception raised when an evaluation fails
+    It holds the original exception and the continuation at the failure.
+    The backtrace of the continuation is rendered only on demand.
+    """
+    depth = 10                  # the number of frames shown by str()
+
+    def __init__(self, exception, continuation):
+        Exception.__init__(self, exception)
+        self.exception, self.continuation = exception, continuation
+
+    def __str__(self):
+        ex = self.exception
+        ss = [type(ex).__name__ + ': ' + str(ex)]
+        ss.extend(self.backtrace(self.depth))
+        return '\n '.join(ss)
+
+    def frames(self):
+        "Yield each (operation, value) of the continuation."
+        k = self.continuation
+        while k is not NOCONT:
+            op, x, k = k
+            yield op, x
+
+    def backtrace(self, depth=None):
+        "Return a list of strings of the frames up to depth, if given."
+        ss = []
+        for op, x in self.frames():
+            if depth is not None and len(ss) == depth:
+                rest = sum(1 for _ in self.frames()) - depth
+                ss.append('... (%d more frames)' % rest)
+                break
+            ss.append('#<%s:%s>' % (op, _abbreviate(x)))
+        return ss
+
+class ResourceError (Exception):
+    "Exception raised when an evaluation exceeds its budget"
+    def __init__(self, reason, budget):
+        Exception.__init__(self, 'ResourceError: ' + reason)
+        self.budget = budget
+
+class Budget (object):
+    """Limits on an evaluation and counters of what it has consumed.
+    Each limit is None if not specified.  timeout is in seconds.
+    The counters are accumulated by evaluate(exp, env, budget).
+    cells counts the cells of argument lists, which arg_cells counts
+    alone, and the cells of the lists made by the list intrinsics such as
+    cons, append and map, but not of the temporary lists they use.
+    """
+    __slots__ = ('max_steps', 'max_depth', 'deadline', 'steps', 'closures',
+                 'cells', 'arg_cells', 'peak_depth')
+
+    def __init__(self, max_steps=None, max_depth=None, timeout=None):
+        self.max_steps, self.max_depth = max_steps, max_depth
+        self.deadline = None if timeout is None else time() + timeout
+        self.steps = self.closures = self.cells = self.arg_cells = 0
+        self.peak_depth = 0
+
+    def __repr__(self):
+        return ('#<budget steps=%d closures=%d cells=%d arg_cells=%d '
+                'peak_depth=%d>' % (self.steps, self.closures, self.cells,
+                                    self.arg_cells, self.peak_depth))
+
+# List library: each function treats a non-pair tail as the end of a list.
+
+def _reverse(lst, tail=NIL):
+    "Return the elements of lst in reverse order prepended to tail."
+    while isinstance(lst, Cell):
+        tail = Cell(lst.car, tail)
+        lst = lst.cdr
+    return tail
+
+def _append(x):
+    "(append lst... obj)"
+    if x is NIL:
+        return NIL
+    lists = _reverse(x)         # Copy lists from the last but one.
+    result, lists = lists.car, lists.cdr
+    while lists is not NIL:
+        result = _reverse(_reverse(lists.car), result)
+        lists = lists.cdr
+    return result
+
+def _eqv(x, y):
+    "Compare two atoms: numbers of the same exactness by value, others by id."
+    if x is y:
+        return True
+    elif isinstance(x, bool) or isinstance(y, bool):
+        return False
+    elif isinstance(x, (int, long)) and isinstance(y, (int, long)):
+        return x == y
+    elif isinstance(x, float) and isinstance(y, float):
+        return x == y
+    return False
+
+def _equal(x, y):
+    "Compare two expressions structurally, terminating on cyclic data."
+    stack, seen = [(x, y)], set()
+    while stack:
+        x, y = stack.pop()
+        if x is y:
+            continue
+        elif isinstance(x, Cell) and isinstance(y, Cell):
+            key = (id(x), id(y))
+            if key not in seen:
+                seen.add(key)
+                stack.append((x.cdr, y.cdr))
+                stack.append((x.car, y.car))
+        elif isinstance(x, SchemeString) and isinstance(y, SchemeString):
+            if x.string != y.string:
+                return False
+        elif isinstance(x, _BYTEVECTORS) and isinstance(y, _BYTEVECTORS):
+            if _view(x) != _view(y):
+                return False
+        elif not _eqv(x, y):
+            return False
+    return True
+
+def _member(x):
+    "(member obj lst [compare])"
+    obj, lst, compare = _optional_compare(x, 'member')
+    if compare is None:
+        while isinstance(lst, Cell):
+            if _equal(obj, lst.car):
+                return lst
+            lst = lst.cdr
+        return False
+    return _member_next(obj, lst, compare)
+
+def _member_next(obj, lst, compare):
+    if not isinstance(lst, Cell):
+        return False
+    return Call(compare, Cell(obj, Cell(lst.car, NIL)), _member_step,
+                (obj, lst, compare))
+
+def _member_step(result, state):
+    obj, lst, compare = state
+    if result is not False:
+        return lst
+    return _member_next(obj, lst.cdr, compare)
+
+def _assoc(x):
+    "(assoc obj alist [compare])"
+    obj, alist, compare = _optional_compare(x, 'assoc')
+    if compare is None:
+        while isinstance(alist, Cell):
+            if _equal(obj, alist.car.car):
+                return alist.car
+            alist = alist.cdr
+        return False
+    return _assoc_next(obj, alist, compare)
+
+def _assoc_next(obj, alist, compare):
+    if not isinstance(alist, Cell):
+        return False
+    return Call(compare, Cell(obj, Cell(alist.car.car, NIL)), _assoc_step,
+                (obj, alist, compare))
+
+def _assoc_step(result, state):
+    obj, alist, compare = state
+    if result is not False:
+        return alist.car
+    return _assoc_next(obj, alist.cdr, compare)
+
+def _optional_compare(x, name):
+    "Return (obj, lst, compare or None) of the arguments x."
+    n = len(x)
+    if n != 2 and n != 3:
+        raise TypeError('arity not matched: %s and %s' %
+                        (name, _abbreviate(x)))
+    return x.car, x.cdr.car, (x.cdr.cdr.car if n == 3 else None)
+
+def _cars_and_cdrs(lists):
+    "Return (the cars, the cdrs) of lists, or None if any of them ends."
+    cars = cdrs = NIL
+    for lst in lists:
+        if not isinstance(lst, Cell):
+            return None
+        cars, cdrs = Cell(lst.car, cars), Cell(lst.cdr, cdrs)
+    return _reverse(cars), _reverse(cdrs)
+
+def _map(x):
+    "(map fun lst...)"
+    if not isinstance(x.cdr, Cell):
+        raise TypeError('arity not matched: map and ' + _abbreviate(x))
+    return _map_next(x.car, x.cdr, NIL)
+
+def _map_next(fun, lists, acc):
+    cc = _cars_and_cdrs(lists)
+    if cc is None:
+        return _reverse(acc)
+    return Call(fun, cc[0], _map_step, (fun, cc[1], acc))
+
+def _map_step(result, state):
+    fun, lists, acc = state
+    return _map_next(fun, lists, Cell(result, acc))
+
+def _for_each(x):
+    "(for-each fun lst...)"
+    if not isinstance(x.cdr, Cell):
+        raise TypeError('arity not matched: for-each and ' + _abbreviate(x))
+    return _for_each_next(x.car, x.cdr)
+
+def _for_each_next(fun, lists):
+    cc = _cars_and_cdrs(lists)
+    if cc is None:
+        return None
+    return Call(fun, cc[0], _for_each_step, (fun, cc[1]))
+
+def _for_each_step(result, state):
+    return _for_each_next(*state)
+
+def _filter(x):
+    "(filter pred lst)"
+    return _filter_next(x.car, x.cdr.car, NIL)
+
+def _filter_next(pred, lst, acc):
+    if not isinstance(lst, Cell):
+        return _reverse(acc)
+    return Call(pred, Cell(lst.car, NIL), _filter_step, (pred, lst, acc))
+
+def _filter_step(result, state):
+    pred, lst, acc = state
+    if result is not False:
+        acc = Cell(lst.car, acc)
+    return _filter_next(pred, lst.cdr, acc)
+
+def _fold(x):
+    "(fold kons knil lst) calls (kons element accumulator) from the left."
+    return _fold_step(x.cdr.car, (x.car, x.cdr.cdr.car))
+
+def _fold_step(acc, state):
+    kons, lst = state
+    if not isinstance(lst, Cell):
+        return acc
+    return Call(kons, Cell(lst.car, Cell(acc, NIL)), _fold_step,
+                (kons, lst.cdr))
+
+def _sort(x):
+    """(sort lst less?) sorts lst stably by bottom-up merge sort.
+    Each state of the sort is made of fresh cells only.
+    """
+    lst, less = x.car, x.cdr.car
+    runs = NIL
+    while isinstance(lst, Cell):
+        runs = Cell(Cell(lst.car, NIL), runs)
+        lst = lst.cdr
+    return _sort_pass(less, _reverse(runs), NIL)
+
+def _sort_pass(less, pending, merged):
+    "Merge each two runs of pending into merged (in reverse order)."
+    if pending is NIL:
+        if merged is NIL:
+            return NIL
+        elif merged.cdr is NIL:
+            return merged.car
+        return _sort_pass(less, _reverse(merged), NIL)
+    elif pending.cdr is NIL:
+        return _sort_pass(less, NIL, Cell(pending.car, merged))
+    a, b = pending.car, pending.cdr.car
+    return _sort_merge(less, a, b, NIL, (pending.cdr.cdr, merged))
+
+def _sort_merge(less, a, b, acc, rest):
+    "Merge runs a and b onto acc (in reverse order)."
+    if a is NIL or b is NIL:
+        run = _reverse(acc, b if a is NIL else a)
+        pending, merged = rest
+        return _sort_pass(less, pending, Cell(run, merged))
+    return Call(less, Cell(b.car, Cell(a.car, NIL)), _sort_step,
+                (less, a, b, acc, rest))
+
+def _sort_step(result, state):
+    less, a, b, acc, rest = state
+    if result is not False:     # b.car < a.car
+        return _sort_merge(less, a, b.cdr, Cell(b.car, acc), rest)
+    return _sort_merge(less, a.cdr, b, Cell(a.car, acc), rest)
+
+# Promises and streams: a stream is () or a pair whose cdr is a promise
+# of a stream.  force follows a chain of delay-force iteratively, and the
+# stream procedures force one promise at a time, so that they run in
+# constant space however long the stream is.
+
+_DONE, _DELAY, _DELAY_FORCE = 0, 1, 2 # kinds of the box of a Promise
+
+class Promise (object):
+    """Promise made by delay, delay-force or make-promise
+    Its box is a list [kind, value], where value is the result if kind is
+    _DONE, or else a thunk.  Promises chained by delay-force share a box.
+    """
+    __slots__ = ('box',)
+
+    def __init__(self, kind, value):
+        self.box = [kind, value]
+
+    def __repr__(self):
+        return '#<promise>'
+
+def _force(x):
+    "(force promise)"
+    p = x.car
+    if not isinstance(p, Promise):
+        return p
+    return _force_next(p)
+
+def _force_next(p):
+    kind, value = p.box
+    if kind == _DONE:
+        return value
+    return Call(value, NIL, _force_step, p)
+
+def _force_step(result, p):
+    box = p.box
+    if box[0] != _DONE:         # unless p has been forced by the thunk...
+        if box[0] == _DELAY or not isinstance(result, Promise):
+            box[0], box[1] = _DONE, result
+        else:                   # Share the box of the promise of delay-force.
+            box[0], box[1] = result.box
+            result.box = box
+    return _force_next(p)
+
+FORCE = Continuable('force', 1, _force)
+
+def _force_then(p, step, state):
+    "Force p and then call step(value, state)."
+    if not isinstance(p, Promise):
+        return step(p, state)
+    elif p.box[0] == _DONE:
+        return step(p.box[1], state)
+    return Call(FORCE, Cell(p, NIL), step, state)
+
+def _lazy(name, fun, state):
+    "Make a promise to call fun(state), which returns a value or a Call."
+    return Promise(_DELAY, Continuable(name, 0, lambda x: fun(state)))
+
+def _make_promise(x):
+    "(make-promise obj)"
+    p = x.car
+    return p if isinstance(p, Promise) else Promise(_DONE, p)
+
+def _stream_map(x):
+    "(stream-map fun stream)"
+    return _stream_map_next(x.cdr.car, x.car)
+
+def _stream_map_next(s, fun):
+    if not isinstance(s, Cell):
+        return NIL
+    return Call(fun, Cell(s.car, NIL), _stream_map_step, (fun, s.cdr))
+
+def _stream_map_step(result, state):
+    return Cell(result, _lazy('stream-map', _stream_map_rest, state))
+
+def _stream_map_rest(state):
+    fun, p = state
+    return _force_then(p, _stream_map_next, fun)
+
+def _stream_filter(x):
+    "(stream-filter pred stream)"
+    return _stream_filter_next(x.cdr.car, x.car)
+
+def _stream_filter_next(s, pred):
+    if not isinstance(s, Cell):
+        return NIL
+    return Call(pred, Cell(s.car, NIL), _stream_filter_step, (pred, s))
+
+def _stream_filter_step(result, state):
+    pred, s = state
+    if result is False:
+        return _force_then(s.cdr, _stream_filter_next, pred)
+    return Cell(s.car, _lazy('stream-filter', _stream_filter_rest,
+                             (pred, s.cdr)))
+
+def _stream_filter_rest(state):
+    pred, p = state
+    return _force_then(p, _stream_filter_next, pred)
+
+def _stream_take(x):
+    "(stream-take n stream)"
+    return _stream_take_next(x.cdr.car, x.car)
+
+def _stream_take_next(s, n):
+    if n <= 0 or not isinstance(s, Cell):
+        return NIL
+    return Cell(s.car, _lazy('stream-take', _stream_take_rest,
+                             (s.cdr, n - 1)))
+
+def _stream_take_rest(state):
+    p, n = state
+    if n <= 0:                  # Do not force the rest needlessly.
+        return NIL
+    return _force_then(p, _stream_take_next, n)
+
+def _stream_fold(x):
+    "(stream-fold kons knil stream) calls (kons element accumulator)."
+    return _stream_fold_next(x.cdr.cdr.car, (x.car, x.cdr.car))
+
+def _stream_fold_next(s, state):
+    kons, acc = state
+    if not isinstance(s, Cell):
+        return acc
+    return Call(kons, Cell(s.car, Cell(acc, NIL)), _stream_fold_step,
+                (kons, s.cdr))
+
+def _stream_fold_step(acc, state):
+    kons, p = state
+    return _force_then(p, _stream_fold_next, (kons, acc))
+
+_STREAM_CHUNK = 64              # elements taken at most without a Call
+
+def _stream_to_list(s, acc=NIL):
+    """(stream->list stream)
+    It makes a Call every _STREAM_CHUNK elements so that a budget can stop
+    it on an infinite stream.
+    """
+    n = _STREAM_CHUNK
+    while isinstance(s, Cell):
+        acc, p = Cell(s.car, acc), s.cdr
+        n -= 1
+        if n == 0 or (isinstance(p, Promise) and p.box[0] != _DONE):
+            return Call(FORCE, Cell(p, NIL), _stream_to_list, acc)
+        s = p.box[1] if isinstance(p, Promise) else p
+    return _reverse(acc)
+
+# Records: define-record-type makes a subclass of Record whose __slots__
+# hold the fields, and defines its procedures as Intrinsics.
+
+DEFINE_RECORD_TYPE = intern('define-record-type')
+
+class Record (object):
+    "Base of the classes made by define-record-type"
+    __slots__ = ()
+    name = 'record'             # name of the type without <>
+    fields = ()                 # field names in the order of __slots__
+
+    def __repr__(self):
+        return stringify(self)
+
+def _record_class(name, fields):
+    "Make a subclass of Record with a slot for each field."
+    slots = tuple('_%d' % i for i in range(len(fields)))
+    return type(name, (Record,), {'__slots__': slots, 'name': name,
+                                  'fields': tuple(fields)})
+
+def _record_constructor(cls, name, slots):
+    setters = [getattr(cls, s).__set__ for s in slots]
+    others = [getattr(cls, s).__set__ for s in cls.__slots__
+              if s not in slots]
+    def make(x):
+        r = cls.__new__(cls)
+        for setter in setters:
+            setter(r, x.car)
+            x = x.cdr
+        for setter in others:
+            setter(r, None)
+        return r
+    return Intrinsic(name, len(slots), make)
+
+def _record_accessor(cls, name, slot):
+    get = getattr(cls, slot).__get__
+    def access(x):
+        r = x.car
+        if r.__class__ is not cls:
+            raise TypeError('not a %s: %s' % (cls.name, _abbreviate(r)))
+        return get(r)
+    return Intrinsic(name, 1, access)
+
+def _record_modifier(cls, name, slot):
+    set = getattr(cls, slot).__set__
+    def modify(x):
+        r = x.car
+        if r.__class__ is not cls:
+            raise TypeError('not a %s: %s' % (cls.name, _abbreviate(r)))
+        set(r, x.cdr.car)
+    return Intrinsic(name, 2, modify)
+
+def _define_record_type(form):
+    """(define-record-type <name> (constructor field...) predicate
+      (field accessor [modifier])...) => (begin (define name 'value)...)
+    """
+    try:
+        type_name, ctor, pred = form.cdr.car, form.cdr.cdr.car, \
+            form.cdr.cdr.cdr.car
+        specs = [spec if isinstance(spec, Cell) else Cell(spec, NIL)
+                 for spec in form.cdr.cdr.cdr.cdr]
+        fields = [spec.car for spec in specs]
+        if isinstance(ctor, str): # constructor of all the fields
+            args = NIL
+            for f in reversed(fields):
+                args = Cell(f, args)
+            ctor = Cell(ctor, args)
+        names = [type_name, ctor.car, pred]
+        for spec in specs:
+            names.extend(spec.cdr)
+        if not all(isinstance(s, str) for s in names + fields + list(ctor)):
+            raise TypeError
+    except (AttributeError, TypeError, ImproperListError):
+        raise SyntaxError('bad define-record-type: ' + _abbreviate(form))
+    cls = _record_class(type_name.lstrip('<').rstrip('>') or type_name,
+                        fields)
+    slot_of = dict(zip(fields, cls.__slots__))
+    for f in ctor.cdr:
+        if f not in slot_of:
+            raise SyntaxError('unknown field %s in %s' % (f, type_name))
+    defs = [(type_name, cls),
+            (ctor.car, _record_constructor(
+                cls, ctor.car, [slot_of[f] for f in ctor.cdr])),
+            (pred, Intrinsic(pred, 1, lambda x: x.car.__class__ is cls))]
+    for spec in specs:
+        slot = slot_of[spec.car]
+        if isinstance(spec.cdr, Cell):
+            accessor = spec.cdr.car
+            defs.append((accessor, _record_accessor(cls, accessor, slot)))
+            if isinstance(spec.cdr.cdr, Cell):
+                modifier = spec.cdr.cdr.car
+                defs.append((modifier, _record_modifier(cls, modifier, slot)))
+    result = NIL
+    for sym, value in reversed(defs):
+        result = Cell(Cell(DEFINE, Cell(sym, Cell(Cell(QUOTE, Cell(
+            value, NIL)), NIL))), result)
+    return Cell(BEGIN, result)
+
+# Bytevectors: a bytevector is a bytearray, or a memoryview (or an mmap
+# in Python 2) which shares the bytes of another bytevector or a file.
+
+BIG = intern('big')
+LITTLE = intern('little')
+
+_BYTEVECTORS = (bytearray, memoryview)
+if bytes is not str:            # for Python 3
+    _BYTEVECTORS += (bytes,)
+else:                           # for Python 2, where an mmap is not viewed
+    import mmap
+    _BYTEVECTORS += (mmap.mmap,)
+
+def _view(bv):
+    "Return a memoryview of bv (or bv itself if impossible in Python 2)."
+    try:
+        return memoryview(bv)
+    except TypeError:
+        return bv
+
+def _check_range(bv, start, end):
+    if not 0 <= start <= end <= len(bv):
+        raise IndexError('bytevector range out of bounds: %d %d (%d)' %
+                         (start, end, len(bv)))
+
+def _range(x, bv):
+    "Return (start, end) from the optional args x of a bytevector."
+    start = x.car if x is not NIL else 0
+    end = x.cdr.car if x is not NIL and x.cdr is not NIL else len(bv)
+    _check_range(bv, start, end)
+    return start, end
+
+def _make_bytevector(x):
+    "(make-bytevector k [fill])"
+    return bytearray([x.cdr.car if x.cdr is not NIL else 0]) * x.car
+
+def _u8_ref(x):
+    "(bytevector-u8-ref bv k)"
+    bv, k = x.car, x.cdr.car
+    _check_range(bv, k, k + 1)
+    b = bv[k]
+    return b if isinstance(b, int) else ord(b) # ord for Python 2
+
+def _u8_set(x):
+    "(bytevector-u8-set! bv k b)"
+    bv, k, b = x.car, x.cdr.car, x.cdr.cdr.car
+    _check_range(bv, k, k + 1)
+    if bytes is str and not isinstance(bv, bytearray): # for Python 2
+        b = chr(b)
+    bv[k] = b
+
+def _int_accessors(code):
+    "Make (ref, set!) of the integers of a struct format code."
+    structs = {BIG: Struct('>' + code), LITTLE: Struct('<' + code)}
+    size = structs[BIG].size
+    def struct_of(endianness):
+        try:
+            return structs[endianness]
+        except KeyError:
+            raise ValueError('bad endianness: ' + _abbreviate(endianness))
+    def ref(x):
+        bv, k, endianness = x.car, x.cdr.car, x.cdr.cdr.car
+        _check_range(bv, k, k + size)
+        return struct_of(endianness).unpack_from(bv, k)[0]
+    def set(x):
+        bv, k = x.car, x.cdr.car
+        n, endianness = x.cdr.cdr.car, x.cdr.cdr.cdr.car
+        _check_range(bv, k, k + size)
+        struct_of(endianness).pack_into(bv, k, n)
+    return ref, set
+
+def _bytevector_copy(x):
+    "(bytevector-copy bv [start [end]])"
+    bv = x.car
+    start, end = _range(x.cdr, bv)
+    return bytearray(_view(bv)[start:end])
+
+def _bytevector_copy_to(x):
+    "(bytevector-copy! to at from [start [end]]) copies without slicing."
+    to, at, bv = x.car, x.cdr.car, x.cdr.cdr.car
+    start, end = _range(x.cdr.cdr.cdr, bv)
+    _check_range(to, at, at + end - start)
+    _view(to)[at:at + end - start] = _view(bv)[start:end]
+
+def _bytevector_slice(x):
+    "(bytevector-slice bv start [end]) shares the bytes of bv."
+    bv = x.car
+    start, end = _range(x.cdr, bv)
+    v = _view(bv)
+    return v[start:end] if v is not bv else bytearray(bv[start:end])
+
+def _mmap_file(x):
+    "(mmap-file path) maps a file read-only."
+    import mmap
+    with open(to_python(x.car), 'rb') as rf:
+        try:
+            m = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:      # The file is empty.
+            return memoryview(b'')
+    return _view(m)
+
+def _utf8_to_string(x):
+    "(utf8->string bv [start [end]])"
+    bv = x.car
+    start, end = _range(x.cdr, bv)
+    return SchemeString(bytearray(_view(bv)[start:end]).decode('utf-8'))
+
+# Strings and string ports: a string port is a StringIO.  display and
+# newline write to the current output port of the thread, which is
+# None for the standard output unless with-output-to-string changes it.
+
+class _Ports (local):
+    "Current ports of each thread"
+    output = None
+
+PORTS = _Ports()
+
+def _string_range(x, s):
+    "Return (start, end) from the optional args x of a string."
+    start = x.car if x is not NIL else 0
+    end = x.cdr.car if x is not NIL and x.cdr is not NIL else len(s)
+    if not 0 <= start <= end <= len(s):
+        raise IndexError('string range out of bounds: %d %d (%d)' %
+                         (start, end, len(s)))
+    return start, end
+
+def _string_ref(x):
+    "(string-ref str k) => a string of one character"
+    s, k = x.car.string, x.cdr.car
+    _string_range(Cell(k, Cell(k + 1, NIL)), s)
+    return SchemeString(s[k])
+
+def _substring(x):
+    "(substring str start [end])"
+    s = x.car.string
+    start, end = _string_range(x.cdr, s)
+    return SchemeString(s[start:end])
+
+def _number_to_string(x):
+    "(number->string n [radix])"
+    n = x.car
+    radix = x.cdr.car if x.cdr is not NIL else 10
+    if radix == 10:
+        return SchemeString(str(n))
+    return SchemeString(format(n, {2: 'b', 8: 'o', 16: 'x'}[radix]))
+
+def _string_to_number(x):
+    "(string->number str [radix]) => a number or #f"
+    s = x.car.string
+    radix = x.cdr.car if x.cdr is not NIL else 10
+    try:
+        return int(s, radix)
+    except ValueError:
+        if radix == 10:
+            try:
+                return float(s)
+            except ValueError:
+                pass
+        return False
+
+def _string_split(x):
+    "(string-split str [separator]) => a list of strings"
+    sep = x.cdr.car.string if x.cdr is not NIL else None
+    result = NIL
+    for e in reversed(x.car.string.split(sep)):
+        result = Cell(SchemeString(e), result)
+    return result
+
+def _display(x):
+    "(display x [port])"
+    port = x.cdr.car if x.cdr is not NIL else PORTS.output
+    print(stringify(x.car, False), end='', file=port)
+
+def _newline(x):
+    "(newline [port])"
+    print(file=x.car if x is not NIL else PORTS.output)
+
+_PEEKED = {}                    # port -> the character peeked from it
+
+def _read_line(x):
+    "(read-line [port]) => a string without newline or an EOF"
+    if x is NIL and STDIN is not None:
+        line = STDIN.read_line()
+    else:
+        port = x.car if x is not NIL else stdin
+        line = _PEEKED.pop(port, '')
+        if line != '\n':
+            line += port.readline()
+    if not line:
+        return EOFError()
+    return SchemeString(line[:-1] if line.endswith('\n') else line)
+
+def _read_char(x, peek=False):
+    "(read-char [port]) => a string of one character or an EOF"
+    if x is NIL and STDIN is not None:
+        c = STDIN.read_char(peek)
+    else:
+        port = x.car if x is not NIL else stdin
+        c = _PEEKED.pop(port, None)
+        if c is None:
+            c = port.read(1)
+        if peek and c:          # Push it back without seeking the port.
+            _PEEKED[port] = c
+    return SchemeString(c) if c else EOFError()
+
+def _with_output_to_string(x):
+    "(with-output-to-string thunk)"
+    port = StringIO()
+    state = (PORTS.output, port)
+    PORTS.output = port
+    return Call(x.car, NIL, _with_output_step, state)
+
+def _with_output_step(result, state):
+    previous, port = state
+    PORTS.output = previous
+    return SchemeString(port.getvalue())
+
+def _restore_output(result, port):
+    "Step of the frame pushed by call/cc to restore the output port"
+    PORTS.output = port
+    return result
+
+# Fasl: a binary format of Scheme data.  After the magic number and the
+# counts, it has the tables of symbols, strings, fixnums, bignums, floats
+# and bytevectors, and then the pairs as indexes into the constants, the
+# tables and the pairs in this order.  Pairs linked by their cdrs are
+# numbered in a row as a run, so that only the car of each pair, the
+# length of each run and the last cdr of each run not ending in () are
+# written.  Each pair, string and bytevector is written once; sharing and
+# cycles are kept.  Arrays of numbers are packed in the narrowest width,
+# and all after the counts is compressed by zlib.  The reader makes all
+# the pairs at once and sets their cars and cdrs with C-level loops,
+# pausing the cyclic GC meanwhile.
+
+FASL_MAGIC = b'FASL\x02'
+_FASL_HEADER = Struct('<14q')
+_FASL_CONSTANTS = (NIL, True, False, None)
+_FASL_LEVEL = 1                 # zlib level: faster to write than smaller
+
+try:
+    from itertools import accumulate as _sums # for Python 3
+except ImportError:
+    def _sums(values):
+        "Yield the running sums of values."
+        total = 0
+        for x in values:
+            total += x
+            yield total
+
+def _to_utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+def _from_utf8(b):
+    return b if bytes is str else b.decode('utf-8')
+
+def _fasl_tag(x):
+    "Return the table of x: 1 symbol, 2 string, ..., 6 bytevector, 7 pair."
+    if isinstance(x, Cell):
+        return 7
+    elif isinstance(x, str):
+        return 1
+    elif isinstance(x, SchemeString):
+        return 2
+    elif isinstance(x, (int, long)):
+        return 3 if -2 ** 63 <= x < 2 ** 63 else 4
+    elif isinstance(x, float):
+        return 5
+    elif isinstance(x, (bytearray, memoryview)):
+        return 6
+    raise TypeError('fasl: not serializable: ' + _abbreviate(x))
+
+def _fasl_pack(values, code=None):
+    "Pack numbers with their type code, 'd' or the narrowest for ints."
+    if code is None:
+        lo, hi = min(values or [0]), max(values or [0])
+        for code in 'bhiq':
+            limit = 1 << (Struct(code).size * 8 - 1)
+            if -limit <= lo and hi < limit:
+                break
+    return code.encode('ascii') + Struct('<%d%s' % (len(values), code)).pack(
+        *values)
+
+def _fasl_array(data, start, n):
+    "Return n numbers packed by _fasl_pack at data[start:] and the end."
+    code = data[start:start + 1].decode('ascii')
+    st = Struct('<%d%s' % (n, code))
+    start += 1
+    end = start + st.size
+    if bytes is not str:        # for Python 3
+        a = array(code)
+        if a.itemsize == st.size // max(n, 1):
+            a.frombytes(memoryview(data)[start:end])
+            if byteorder == 'big':
+                a.byteswap()
+            return a, end
+    return st.unpack_from(data, start), end
+
+def fasl_dumps(obj):
+    "Convert a Scheme value to bytes in the fasl format."
+    tables = ([], [], [], [], [], [], [])       # tag => atoms
+    indexes = ({}, {}, {}, {}, {}, {}, {}, {})  # tag => {key: tagged index}
+    cars, lengths, tails, stack = [], [], [], []
+    def ref(x):
+        "Return the index of x in its table, tagged in the low 3 bits."
+        if x is NIL or x is True or x is False or x is None:
+            return _FASL_CONSTANTS.index(x) << 3
+        tag = _fasl_tag(x)
+        if tag == 5:
+            floats = tables[5]
+            floats.append(x)
+            return (len(floats) - 1) << 3 | 5
+        key = x if tag in (1, 3, 4) else id(x)
+        index = indexes[tag]
+        r = index.get(key)
+        if r is None:
+            if tag == 7:        # Number the pairs in a row as a run.
+                r, run = len(cars) << 3 | 7, []
+                while isinstance(x, Cell) and id(x) not in index:
+                    index[id(x)] = len(cars) << 3 | 7
+                    cars.append(None)
+                    run.append(x)
+                    x = x.cdr
+                stack.append((len(tails), run))
+                lengths.append(len(run))
+                tails.append(None)
+            else:
+                table = tables[tag]
+                r = index[key] = len(table) << 3 | tag
+                table.append(x)
+        return r
+    root = ref(obj)
+    while stack:
+        k, run = stack.pop()
+        i = indexes[7][id(run[-1])] >> 3
+        for x in reversed(run):
+            cars[i] = ref(x.car)
+            i -= 1
+        tails[k] = ref(run[-1].cdr)
+    bases, n = [0], len(_FASL_CONSTANTS)
+    for table in tables[1:] + (cars,):
+        bases.append(n)
+        n += len(table)
+    remap = lambda r: bases[r & 7] + (r >> 3)
+    syms, strs, ints, bigs, floats, bvs = tables[1:]
+    texts = [_to_utf8(s.string) for s in strs]
+    sym_bytes = b'\0'.join(_to_utf8(s) for s in syms)
+    str_bytes = b''.join(texts)
+    big_bytes = ' '.join(str(b) for b in bigs).encode('ascii')
+    bv_bytes = b''.join(bytes(bytearray(b)) for b in bvs)
+    runs = [k for k, r in enumerate(tails) if r != 0] # not ending in ()
+    import zlib
+    return FASL_MAGIC + _FASL_HEADER.pack(
+        len(syms), len(sym_bytes), len(strs), len(str_bytes), len(ints),
+        len(bigs), len(big_bytes), len(floats), len(bvs), len(bv_bytes),
+        len(cars), len(lengths), len(runs), remap(root)) + zlib.compress(
+        b''.join([
+        sym_bytes,
+        _fasl_pack([len(s) for s in texts]), str_bytes,
+        _fasl_pack(ints),
+        big_bytes,
+        _fasl_pack(floats, 'd'),
+        _fasl_pack([len(b) for b in bvs]), bv_bytes,
+        _fasl_pack([remap(r) for r in cars]),
+        _fasl_pack(lengths),
+        _fasl_pack(runs),
+        _fasl_pack([remap(tails[k]) for k in runs])]), _FASL_LEVEL)
+
+def fasl_loads(data):
+    "Convert bytes in the fasl format back to a Scheme value."
+    if not isinstance(data, bytes):
+        data = bytes(bytearray(data))
+    if data[:len(FASL_MAGIC)] != FASL_MAGIC:
+        raise ValueError('fasl: bad magic number')
+    enabled = gc.isenabled()
+    gc.disable()                # Nothing made here is garbage.
+    try:
+        return _fasl_decode(data)
+    finally:
+        if enabled:
+            gc.enable()
+
+def _fasl_decode(data):
+    import zlib
+    (nsym, sym_len, nstr, str_len, nint, nbig, big_len, nfloat, nbv, bv_len,
+     ncell, nrun, ntail, root) = _FASL_HEADER.unpack_from(data,
+                                                          len(FASL_MAGIC))
+    data = zlib.decompress(data[len(FASL_MAGIC) + _FASL_HEADER.size:])
+    pos = 0
+    blob, pos = data[pos:pos + sym_len], pos + sym_len
+    syms = list(map(intern, _from_utf8(blob).split('\0'))) if nsym else []
+    lengths, pos = _fasl_array(data, pos, nstr)
+    blob, pos = data[pos:pos + str_len], pos + str_len
+    stops = list(_sums(lengths))
+    texts = imap(blob.__getitem__, imap(slice, [0] + stops, stops))
+    if bytes is not str:        # for Python 3
+        texts = imap(bytes.decode, texts)
+    strs = list(imap(SchemeString, texts))
+    ints, pos = _fasl_array(data, pos, nint)
+    blob, pos = data[pos:pos + big_len], pos + big_len
+    bigs = list(map(long, blob.split())) if nbig else []
+    floats, pos = _fasl_array(data, pos, nfloat)
+    lengths, pos = _fasl_array(data, pos, nbv)
+    bvs = []
+    for n in lengths:
+        bvs.append(bytearray(data[pos:pos + n]))
+        pos += n
+    cars, pos = _fasl_array(data, pos, ncell)
+    lengths, pos = _fasl_array(data, pos, nrun)
+    runs, pos = _fasl_array(data, pos, ntail)
+    tails, pos = _fasl_array(data, pos, ntail)
+    objs = list(_FASL_CONSTANTS)
+    for table in (syms, strs, ints, bigs, floats, bvs):
+        objs.extend(table)
+    base = len(objs)
+    objs.extend(starmap(Cell.__new__, repeat((Cell,), ncell)))
+    get = objs.__getitem__
+    deque(imap(setattr, islice(objs, base, None), repeat('car'),
+               imap(get, cars)), 0)
+    deque(imap(setattr, islice(objs, base, None), repeat('cdr'),
+               islice(objs, base + 1, None)), 0)
+    ends = list(imap(get, islice(_sums(chain([base - 1], lengths)), 1, None)))
+    deque(imap(setattr, ends, repeat('cdr'), repeat(NIL, nrun)), 0)
+    deque(imap(setattr, imap(ends.__getitem__, runs), repeat('cdr'),
+               imap(get, tails)), 0)
+    return objs[root]
+
+def fasl_write(obj, file):
+    "Write a Scheme value to a binary file in the fasl format."
+    file.write(fasl_dumps(obj))
+
+def fasl_read(file):
+    "Read a Scheme value from a binary file in the fasl format."
+    return fasl_loads(file.read())
+
+def _fasl_write(x):
+    "(fasl-write obj [path]) => a bytevector, or writes it to path"
+    data = fasl_dumps(x.car)
+    if x.cdr is NIL:
+        return bytearray(data)
+    with open(x.cdr.car.string, 'wb') as f:
+        f.write(data)
+
+def _fasl_read(x):
+    "(fasl-read bytevector-or-path)"
+    if isinstance(x.car, SchemeString):
+        with open(x.car.string, 'rb') as f:
+            return fasl_read(f)
+    return fasl_loads(x.car)
+
+# Python FFI: Scheme strings and lists are converted to Python str and
+# list and vice versa; other values are passed as they are.
+
+def to_python(exp):
+    "Convert a Scheme value to a Python value."
+    if isinstance(exp, SchemeString):
+        return exp.string
+    elif not isinstance(exp, List):
+        return exp
+    result = []
+    stack = [(exp, result)]     # Use a stack instead of recursion.
+    while stack:
+        j, out = stack.pop()
+        while isinstance(j, Cell):
+            e = j.car
+            if isinstance(e, SchemeString):
+                out.append(e.string)
+            elif isinstance(e, List):
+                out.append([])
+                stack.append((e, out[-1]))
+            else:
+                out.append(e)
+            j = j.cdr
+        if j is not NIL:
+            raise ImproperListError(j)
+    return result
+
+def from_python(obj):
+    "Convert a Python value to a Scheme value."
+    if isinstance(obj, (str, unicode)):
+        return SchemeString(obj)
+    elif not isinstance(obj, (list, tuple)):
+        return obj
+    top = Cell(None, NIL)
+    stack = [(obj, top)]        # Use a stack instead of recursion.
+    while stack:
+        seq, holder = stack.pop()
+        y = z = Cell(NIL, NIL)
+        for e in seq:
+            y.cdr = Cell(e, NIL)
+            y = y.cdr
+            if isinstance(e, (str, unicode)):
+                y.car = SchemeString(e)
+            elif isinstance(e, (list, tuple)):
+                stack.append((e, y))
+        holder.car = z.cdr
+    return top.car
+
+def _py_call(fun, x):
+    "Call a Python function with the arguments x converted to Python."
+    args = []
+    while x is not NIL:
+        args.append(to_python(x.car))
+        x = x.cdr
+    return from_python(fun(*args))
+
+def _py_getattr(x):
+    "(py-getattr obj name) where name may be dotted as 'path.join'."
+    obj, name = x.car, x.cdr.car
+    if isinstance(name, SchemeString):
+        name = name.string
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+def _py_procedure(name, fun):
+    "Make an Intrinsic which calls a Python function through _py_call."
+    return Intrinsic(name, -1, lambda x: _py_call(fun, x))
+
 _ = lambda n, a, f, next: Environment(intern(n), Intrinsic(n, a, f), next)
+_c = lambda n, a, f, next: Environment(intern(n), Continuable(n, a, f), next)
 
 GLOBAL_ENV = (
     _('+', 2, lambda x: x.car + x.cdr.car,
@@ -199,14 +1528,105 @@ GLOBAL_ENV = (
                     None)))))))))
 
 GLOBAL_ENV = (
-    _('display', 1, lambda x: print(stringify(x.car, False), end=''),
-      _('newline', 0, lambda x: print(),
+    _('display', -1, _display,
+      _('newline', -1, _newline,
         _('read', 0, lambda x: read_expression('', ''),
           _('eof-object?', 1, lambda x: isinstance(x.car, EOFError),
             _('symbol?', 1, lambda x: isinstance(x.car, str),
               Environment(CALLCC, CALLCC_OBJ,
                           Environment(APPLY, APPLY_OBJ,
-                                      GLOBAL_ENV))))))))
+                                      Environment(CHECKPOINT, CHECKPOINT_OBJ,
+                                                  GLOBAL_ENV)))))))))
+
+GLOBAL_ENV = (
+    _('append', -1, _append,
+      _('reverse', 1, lambda x: _reverse(x.car),
+        _('equal?', 2, lambda x: _equal(x.car, x.cdr.car),
+          _c('member', -1, _member,
+            _c('assoc', -1, _assoc,
+              _c('map', -1, _map,
+                _c('for-each', -1, _for_each,
+                  _c('filter', 2, _filter,
+                    _c('fold', 3, _fold,
+                      _c('sort', 2, _sort,
+                        GLOBAL_ENV)))))))))))
+
+GLOBAL_ENV = (
+    _('make-promise', 1, _make_promise,
+      _('promise?', 1, lambda x: isinstance(x.car, Promise),
+        _('%delay', 1, lambda x: Promise(_DELAY, x.car),
+          _('%delay-force', 1, lambda x: Promise(_DELAY_FORCE, x.car),
+            Environment(intern('force'), FORCE,
+              _('stream-car', 1, lambda x: x.car.car,
+                _c('stream-cdr', 1, lambda x: _force(Cell(x.car.cdr, NIL)),
+                  _c('stream-map', 2, _stream_map,
+                    _c('stream-filter', 2, _stream_filter,
+                      _c('stream-take', 2, _stream_take,
+                        _c('stream-fold', 3, _stream_fold,
+                          _c('stream->list', 1,
+                             lambda x: _stream_to_list(x.car),
+                             GLOBAL_ENV)))))))))))))
+
+GLOBAL_ENV = (
+    _('bytevector?', 1, lambda x: isinstance(x.car, _BYTEVECTORS),
+      _('make-bytevector', -1, _make_bytevector,
+        _('bytevector', -1, lambda x: bytearray(x),
+          _('bytevector-length', 1, lambda x: len(x.car),
+            _('bytevector-u8-ref', 2, _u8_ref,
+              _('bytevector-u8-set!', 3, _u8_set,
+                _('bytevector-copy', -1, _bytevector_copy,
+                  _('bytevector-copy!', -1, _bytevector_copy_to,
+                    _('bytevector-slice', -1, _bytevector_slice,
+                      _('mmap-file', 1, _mmap_file,
+                        _('utf8->string', -1, _utf8_to_string,
+                          _('string->utf8', 1, lambda x: bytearray(
+                              x.car.string.encode('utf-8')),
+                            GLOBAL_ENV)))))))))))))
+
+for _name, _code in (('u16', 'H'), ('s16', 'h'), ('u32', 'I'),
+                     ('s32', 'i'), ('u64', 'Q'), ('s64', 'q')):
+    _ref, _set = _int_accessors(_code)
+    GLOBAL_ENV = _('bytevector-%s-ref' % _name, 3, _ref,
+                   _('bytevector-%s-set!' % _name, 4, _set, GLOBAL_ENV))
+del _name, _code, _ref, _set
+
+GLOBAL_ENV = (
+    _('string?', 1, lambda x: isinstance(x.car, SchemeString),
+      _('string-length', 1, lambda x: len(x.car.string),
+        _('string-ref', 2, _string_ref,
+          _('substring', -1, _substring,
+            _('string-append', -1,
+              lambda x: SchemeString(''.join(s.string for s in x)),
+              _('string->symbol', 1, lambda x: intern(x.car.string),
+                _('symbol->string', 1, lambda x: SchemeString(x.car),
+                  _('number->string', -1, _number_to_string,
+                    _('string->number', -1, _string_to_number,
+                      _('string-split', -1, _string_split,
+                        GLOBAL_ENV)))))))))))
+
+GLOBAL_ENV = (
+    _('open-output-string', 0, lambda x: StringIO(),
+      _('get-output-string', 1, lambda x: SchemeString(x.car.getvalue()),
+        _('open-input-string', 1, lambda x: StringIO(x.car.string),
+          _('read-line', -1, _read_line,
+            _('read-char', -1, _read_char,
+              _('peek-char', -1, lambda x: _read_char(x, True),
+                _c('with-output-to-string', 1, _with_output_to_string,
+                  GLOBAL_ENV))))))))
+
+GLOBAL_ENV = (
+    _('fasl-write', -1, _fasl_write,
+      _('fasl-read', 1, _fasl_read,
+        GLOBAL_ENV)))
+
+GLOBAL_ENV = (
+    _('py-import', 1, lambda x: import_module(to_python(x.car)),
+      _('py-getattr', 2, _py_getattr,
+        _('py-call', -1, lambda x: _py_call(x.car, x.cdr),
+          _('define-intrinsic', 2,
+            lambda x: define_intrinsic(to_python(x.car), -1, x.cdr.car,
+                                       TOP_LEVEL.env),
+            GLOBAL_ENV)))))
 
 GLOBAL_ENV = Environment(
     None, None,                 # marker of the frame top
@@ -221,10 +1641,263 @@ GLOBAL_ENV = Environment(
                     GLOBAL_ENV)))))))))
 
 
-def evaluate(exp, env=GLOBAL_ENV):
-    "Evaluate an expression in an environment."
-    k = NOCONT
+def define_intrinsic(name, arity, fun, env=GLOBAL_ENV):
+    """Define a built-in function in the top-level env.
+    If arity is negative, the function takes any number of arguments.
+    If fun is an Intrinsic, it is defined as it is.  Otherwise, fun is
+    a Python function which is called with the arguments converted to
+    Python, and its result is converted back to Scheme.
+    """
+    if not isinstance(fun, Intrinsic):
+        if arity < 0:
+            fun = _py_procedure(name, fun)
+        else:
+            f = fun
+            fun = Intrinsic(name, arity, lambda x: _py_call(f, x))
+    _define(env, intern(name), fun)
+
+
+# Macros: MACROS maps each keyword to a function which takes a macro use
+# and returns its expansion.  Each macro use is expanded in place only
+# once, when the top-level expression is evaluated or the lambda
+# expression around it is analyzed; the evaluator never sees it again.
+# TOP_LEVEL holds the top-level env and macros of the current thread,
+# which are GLOBAL_ENV and MACROS unless a server session replaces them.
+
+DEFINE_SYNTAX = intern('define-syntax')
+SYNTAX_RULES = intern('syntax-rules')
+ELLIPSIS = intern('...')
+UNDERSCORE = intern('_')
+FRESH_NUMBERS = count(1)        # suffixes of the symbols renamed by macros
+
+# Keywords whose templates bind the symbols in ((v e)...) for hygiene
+_BINDING_FORMS = frozenset(intern(s) for s in ('let', 'let*', 'letrec',
+                                                'letrec*'))
+
+class SyntaxRules (object):
+    """Transformer of (syntax-rules (literal...) (pattern template)...)
+    Symbols which the template binds with lambda or let are renamed to
+    fresh symbols at each expansion.
+    """
+    __slots__ = ('name', 'ellipsis', 'literals', 'rules')
+
+    def __init__(self, name, spec):
+        self.name, self.ellipsis = name, ELLIPSIS
+        if isinstance(spec, Cell) and isinstance(spec.car, str):
+            self.ellipsis, spec = spec.car, spec.cdr # custom ellipsis
+        if not isinstance(spec, Cell):
+            raise SyntaxError('bad syntax-rules: ' + _abbreviate(spec))
+        self.literals = frozenset(spec.car)
+        self.rules = []
+        for rule in spec.cdr:
+            if not (isinstance(rule, Cell) and isinstance(rule.car, Cell) and
+                    isinstance(rule.cdr, Cell)):
+                raise SyntaxError('bad syntax rule: ' + _abbreviate(rule))
+            pattern, template = rule.car.cdr, rule.cdr.car
+            pvars, binders = set(), set()
+            self._pattern_vars(pattern, pvars)
+            _binders(template, binders)
+            self.rules.append((pattern, template,
+                               frozenset(binders - pvars - {self.ellipsis})))
+
+    def __repr__(self):
+        return '#<syntax-rules:%s>' % self.name
+
+    def __call__(self, form):
+        "Expand a macro use."
+        for pattern, template, binders in self.rules:
+            b = {}
+            if self._match(pattern, form.cdr, b):
+                renames = dict((v, intern('%s.%d' % (v, next(FRESH_NUMBERS))))
+                               for v in binders)
+                return self._instantiate(template, b, renames)
+        raise SyntaxError('no syntax rule matches: ' + _abbreviate(form))
+
+    def _pattern_vars(self, pat, result):
+        while isinstance(pat, Cell):
+            self._pattern_vars(pat.car, result)
+            pat = pat.cdr
+        if isinstance(pat, str) and not (pat in self.literals or
+                                         pat is self.ellipsis or
+                                         pat is UNDERSCORE):
+            result.add(pat)
+
+    def _match(self, pat, form, b):
+        "Match form against pat, binding pattern variables in b."
+        while isinstance(pat, Cell):
+            if isinstance(pat.cdr, Cell) and pat.cdr.car is self.ellipsis:
+                rest = pat.cdr.cdr
+                n = _pairs(form) - _pairs(rest)
+                matches = []
+                for i in range(n):
+                    d = {}
+                    if not self._match(pat.car, form.car, d):
+                        return False
+                    matches.append(d)
+                    form = form.cdr
+                pvars = set()
+                self._pattern_vars(pat.car, pvars)
+                for v in pvars:
+                    b[v] = [d[v] for d in matches]
+                pat = rest
+            elif isinstance(form, Cell):
+                if not self._match(pat.car, form.car, b):
+                    return False
+                pat, form = pat.cdr, form.cdr
+            else:
+                return False
+        if isinstance(pat, str):
+            if pat in self.literals:
+                return form is pat
+            if pat is not UNDERSCORE:
+                b[pat] = form
+            return True
+        return _equal(pat, form)
+
+    def _instantiate(self, tmpl, b, renames):
+        "Build a copy of tmpl substituting pattern variables bound in b."
+        if isinstance(tmpl, str):
+            if tmpl in b:
+                value = b[tmpl]
+                if isinstance(value, list):
+                    raise SyntaxError('no ... follows ' + tmpl + ' in ' +
+                                      self.name)
+                return value
+            return renames.get(tmpl, tmpl)
+        elif not isinstance(tmpl, Cell):
+            return tmpl
+        elif tmpl.car is QUOTE:
+            renames = {}        # Leave quoted symbols as they are.
+        items = []
+        while isinstance(tmpl, Cell):
+            e = tmpl.car
+            if isinstance(tmpl.cdr, Cell) and tmpl.cdr.car is self.ellipsis:
+                syms = set()
+                _symbols(e, syms)
+                pvars = [v for v in syms if isinstance(b.get(v), list)]
+                if not pvars:
+                    raise SyntaxError('no pattern variable before ... in ' +
+                                      self.name)
+                n = len(b[pvars[0]])
+                if any(len(b[v]) != n for v in pvars):
+                    raise SyntaxError('unequal lengths for ... in ' +
+                                      self.name)
+                for i in range(n):
+                    d = dict(b)
+                    for v in pvars:
+                        d[v] = b[v][i]
+                    items.append(self._instantiate(e, d, renames))
+                tmpl = tmpl.cdr.cdr
+            else:
+                items.append(self._instantiate(e, b, renames))
+                tmpl = tmpl.cdr
+        result = self._instantiate(tmpl, b, renames)
+        for e in reversed(items):
+            result = Cell(e, result)
+        return result
+
+def _pairs(x):
+    "Count the pairs of a list."
+    n = 0
+    while isinstance(x, Cell):
+        n += 1
+        x = x.cdr
+    return n
+
+def _symbols(x, result):
+    "Add the symbols in x to result."
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        while isinstance(x, Cell):
+            stack.append(x.car)
+            x = x.cdr
+        if isinstance(x, str):
+            result.add(x)
+
+def _binders(tmpl, result):
+    "Add the symbols which tmpl binds with lambda or let to result."
+    stack = [tmpl]
+    while stack:
+        x = stack.pop()
+        if not isinstance(x, Cell) or x.car is QUOTE:
+            continue
+        kar = x.car
+        if kar is LAMBDA and isinstance(x.cdr, Cell):
+            _symbols(x.cdr.car, result)
+        elif kar in _BINDING_FORMS and isinstance(x.cdr, Cell):
+            bindings = x.cdr.car
+            if isinstance(bindings, str) and isinstance(x.cdr.cdr, Cell):
+                result.add(bindings) # named let
+                bindings = x.cdr.cdr.car
+            while isinstance(bindings, Cell):
+                if isinstance(bindings.car, Cell):
+                    if isinstance(bindings.car.car, str):
+                        result.add(bindings.car.car)
+                bindings = bindings.cdr
+        while isinstance(x, Cell):
+            stack.append(x.car)
+            x = x.cdr
+
+def _define_syntax(form):
+    "(define-syntax name (syntax-rules ...)) => (quote None)"
+    try:
+        name, spec = form.cdr.car, form.cdr.cdr.car
+    except AttributeError:
+        name = spec = None
+    if not (isinstance(name, str) and isinstance(spec, Cell) and
+            spec.car is SYNTAX_RULES):
+        raise SyntaxError('bad define-syntax: ' + _abbreviate(form))
+    TOP_LEVEL.macros[name] = SyntaxRules(name, spec.cdr)
+    return Cell(QUOTE, Cell(None, NIL))
+
+MACROS = {DEFINE_SYNTAX: _define_syntax,
+          DEFINE_RECORD_TYPE: _define_record_type}
+
+class _TopLevel (local):
+    "Current top-level env and macros of each thread"
+    env, macros = GLOBAL_ENV, MACROS
+
+TOP_LEVEL = _TopLevel()
+
+def expand(exp):
+    """Expand the macro uses in exp in place and return exp.
+    The bodies of lambda expressions are left for _analyze.
+    """
+    stack, macros = [exp], TOP_LEVEL.macros
+    while stack:
+        x = stack.pop()
+        if not isinstance(x, Cell):
+            continue
+        kar = x.car
+        while isinstance(kar, str) and kar in macros:
+            y = macros[kar](x)
+            if isinstance(y, Cell):
+                x.car, x.cdr = y.car, y.cdr
+            else:
+                x.car, x.cdr = BEGIN, Cell(y, NIL)
+            kar = x.car
+        if kar is QUOTE or kar is LAMBDA or kar.__class__ is LambdaInfo:
+            continue
+        items = []
+        while isinstance(x, Cell):
+            items.append(x.car)
+            x = x.cdr
+        items.reverse()         # Expand subexpressions from left to right.
+        stack.extend(items)
+    return exp
+
+
+def evaluate(exp, env=GLOBAL_ENV, budget=None):
+    """Evaluate an expression in an environment.
+    If a Budget is given or Hooks are set, run the metered evaluator.
+    """
+    if budget is not None or HOOKS is not None:
+        return _evaluate_metered(exp, env,
+                                 Budget() if budget is None else budget, HOOKS)
+    k, output = NOCONT, PORTS.output
     try:
+        expand(exp)
         while True:
             while True:
                 if isinstance(exp, Cell):
@@ -238,8 +1911,8 @@ def evaluate(exp, env=GLOBAL_ENV):
                         exp = kdr.car
                         if kdr.cdr is not NIL:
                             k = (BEGIN, kdr.cdr, k)
-                    elif kar is LAMBDA: # (lambda (v...) e...)
-                        exp = Closure(kdr.car, kdr.cdr, env)
+                    elif kar is LAMBDA or kar.__class__ is LambdaInfo:
+                        exp = _make_closure(exp, env) # (lambda (v...) e...)
                         break
                     elif kar is DEFINE: # (define v e)
                         v = kdr.car
@@ -274,10 +1947,9 @@ def evaluate(exp, env=GLOBAL_ENV):
                     exp = x.car
                     break
                 elif op is DEFINE: # x = v
-                    assert env.sym is None # Check for the marker.
-                    env.next = Environment(x, exp, env.next)
+                    _define(env, x, exp)
                     exp = None
-                elif op is SETQ: # x = Environment(v, e, next)
+                elif op is SETQ: # x = Environment(v, e, next) or Box(e)
                     x.val = exp
                     exp = None
                 elif op is APPLY: # x = args; exp = fun
@@ -301,56 +1973,905 @@ def evaluate(exp, env=GLOBAL_ENV):
                         exp, k, env = apply_function(exp, args, k, env)
                     else:
                         raise RuntimeError('unexpected op: %s: %s' %
-                                           (stringify(op), stringify(exp)))
+                                           (op, _abbreviate(exp)))
                 elif op is RESTORE_ENV: # x = env
                     env = x
+                elif op is RESUME: # x = Call of a Continuable
+                    exp, k, env = call_back(x.step(exp, x.state), k, env)
                 else:
                     raise RuntimeError('bad op: %s: %s' %
-                                       (stringify(op), stringify(x)))
+                                       (op, _abbreviate(x)))
     except ErrorException:
         raise
     except Exception as ex:
-        msg = type(ex).__name__ + ': ' + str(ex)
-        if k is not NOCONT:
-            msg += '\n ' + stringify(k)
-        raise Exception(msg)
+        raise EvaluationError(ex, k)
+    finally:
+        PORTS.output = output   # in case of an escape from a string port
+
+def _intrinsic(name):
+    return GLOBAL_ENV.look_for(intern(name)).val
+
+def _appended(result, x):
+    "Count the cells made by (append . x), which shares the last argument."
+    while isinstance(x, Cell) and x.cdr is not NIL:
+        x = x.cdr
+    return _pairs(result) - (_pairs(x.car) if isinstance(x, Cell) else 0)
+
+# Intrinsics, and steps of Continuables, which return new lists; each maps
+# to a function of (result, arguments or state) counting the cells made.
+_LIST_MAKERS = {
+    _intrinsic('cons'): lambda r, x: 1,
+    _intrinsic('append'): _appended,
+    _intrinsic('reverse'): lambda r, x: _pairs(r),
+    _intrinsic('sort'): lambda r, x: _pairs(r),
+    _intrinsic('stream->list'): lambda r, x: _pairs(r),
+    _intrinsic('string-split'): lambda r, x: _pairs(r),
+    _map_step: lambda r, s: _pairs(r),
+    _filter_step: lambda r, s: _pairs(r),
+    _sort_step: lambda r, s: _pairs(r),
+    _stream_to_list: lambda r, s: _pairs(r)}
+
+def _count_cells(budget, maker, result, arg):
+    "Count the cells of the list returned by maker, if it is a list maker."
+    count = _LIST_MAKERS.get(maker)
+    if count is not None and result.__class__ is not Call:
+        budget.cells += count(result, arg)
+
+def _evaluate_metered(exp, env, budget, hooks=None):
+    """Evaluate an expression in an environment within a budget.
+    It is the same as evaluate except that it counts steps, closures,
+    cells and the continuation depth and raises ResourceError on excess.
+    It also calls the hooks, if any.
+    """
+    if hooks is None:
+        hooks = _NO_HOOKS
+    on_eval = hooks.on_eval
+    frames = {} # (id(env), id(k)) -> (frame, fun) of (RESTORE_ENV, env, k)
+    max_steps, max_depth = budget.max_steps, budget.max_depth
+    deadline = budget.deadline
+    steps, closures, cells = budget.steps, budget.closures, budget.arg_cells
+    peak = budget.peak_depth
+    k, depth, next_check = NOCONT, 0, steps
+    output = PORTS.output
+    try:
+        expand(exp)
+        while True:
+            while True:
+                steps += 1
+                if depth > peak:
+                    peak = depth
+                    if max_depth is not None and peak > max_depth:
+                        raise ResourceError('continuation too deep', budget)
+                if max_steps is not None and steps > max_steps:
+                    raise ResourceError('too many steps', budget)
+                if deadline is not None and steps >= next_check:
+                    next_check = steps + 1024
+                    if time() > deadline:
+                        raise ResourceError('deadline exceeded', budget)
+                if on_eval is not None:
+                    on_eval(exp, env)
+                if isinstance(exp, Cell):
+                    kar, kdr = exp.car, exp.cdr
+                    if kar is QUOTE: # (quote e)
+                        exp = kdr.car
+                        break
+                    elif kar is IF: # (if e1 e2 e3) or (if e1 e2)
+                        exp, k = kdr.car, (THEN, kdr.cdr, k)
+                        depth += 1
+                    elif kar is BEGIN: # (begin e...)
+                        exp = kdr.car
+                        if kdr.cdr is not NIL:
+                            k = (BEGIN, kdr.cdr, k)
+                            depth += 1
+                    elif kar is LAMBDA or kar.__class__ is LambdaInfo:
+                        exp = _make_closure(exp, env) # (lambda (v...) e...)
+                        closures += 1
+                        break
+                    elif kar is DEFINE: # (define v e)
+                        v = kdr.car
+                        assert isinstance(v, str), v
+                        exp, k = kdr.cdr.car, (DEFINE, v, k)
+                        depth += 1
+                    elif kar is SETQ: # (set! v e)
+                        exp, k = kdr.cdr.car, (SETQ, env.look_for(kdr.car), k)
+                        depth += 1
+                    else:
+                        exp, k = kar, (APPLY, kdr, k)
+                        depth += 1
+                elif isinstance(exp, str):
+                    exp = env.look_for(exp).val
+                    break
+                else:           # as a number, #t, #f etc.
+                    break
+            while True:
+                if k is NOCONT:
+                    return exp
+                steps += 1
+                op, x, k = k
+                depth -= 1
+                if op is THEN:  # x = (e2 e3)
+                    if exp is False:
+                        if x.cdr is NIL:
+                            exp = None
+                        else:
+                            exp = x.cdr.car # e3
+                            break
+                    else:
+                        exp = x.car # e2
+                        break
+                elif op is BEGIN: # x = (e...)
+                    if x.cdr is not NIL: # unless tail call...
+                        k = (BEGIN, x.cdr, k)
+                        depth += 1
+                    exp = x.car
+                    break
+                elif op is DEFINE: # x = v
+                    _define(env, x, exp)
+                    exp = None
+                elif op is SETQ: # x = Environment(v, e, next) or Box(e)
+                    x.val = exp
+                    exp = None
+                elif op is APPLY: # x = args; exp = fun
+                    if x is NIL:
+                        k0 = k
+                        budget.steps = steps
+                        exp, k, env = _apply_metered(exp, NIL, k, env, depth,
+                                                     hooks, frames, budget)
+                        steps = budget.steps
+                        depth = _depth_after(k, k0, depth)
+                        if depth > peak:
+                            peak = depth
+                            if max_depth is not None and peak > max_depth:
+                                raise ResourceError('continuation too deep',
+                                                    budget)
+                    else:
+                        k = (APPLY_FUN, exp, k)
+                        depth += 1
+                        while x.cdr is not NIL:
+                            k = (EVAL_ARG, x.car, k)
+                            depth += 1
+                            x = x.cdr
+                        exp = x.car
+                        k = (CONS_ARGS, NIL, k)
+                        depth += 1
+                        break
+                elif op is CONS_ARGS: # x = evaluated args
+                    args = Cell(exp, x)
+                    cells += 1
+                    op, exp, k = k
+                    depth -= 1
+                    if op is EVAL_ARG: # exp = the next arg
+                        k = (CONS_ARGS, args, k)
+                        depth += 1
+                        break
+                    elif op is APPLY_FUN: # exp = evaluated fun
+                        k0 = k
+                        budget.steps = steps
+                        exp, k, env = _apply_metered(exp, args, k, env, depth,
+                                                     hooks, frames, budget)
+                        steps = budget.steps
+                        depth = _depth_after(k, k0, depth)
+                        if depth > peak:
+                            peak = depth
+                            if max_depth is not None and peak > max_depth:
+                                raise ResourceError('continuation too deep',
+                                                    budget)
+                    else:
+                        raise RuntimeError('unexpected op: %s: %s' %
+                                           (op, _abbreviate(exp)))
+                elif op is RESTORE_ENV: # x = env
+                    env = x
+                    if frames:
+                        call = frames.pop((id(x), id(k)), None)
+                        if call is not None:
+                            hooks.on_return(call[1], exp, depth)
+                elif op is RESUME: # x = Call of a Continuable
+                    k0 = k
+                    budget.steps = steps
+                    exp = x.step(exp, x.state)
+                    _count_cells(budget, x.step, exp, x.state)
+                    exp, k, env = _call_back_metered(exp, k, env, depth,
+                                                     hooks, frames, budget)
+                    steps = budget.steps
+                    depth = _depth_after(k, k0, depth)
+                    if depth > peak:
+                        peak = depth
+                        if max_depth is not None and peak > max_depth:
+                            raise ResourceError('continuation too deep',
+                                                budget)
+                else:
+                    raise RuntimeError('bad op: %s: %s' %
+                                       (op, _abbreviate(x)))
+    except (ErrorException, ResourceError):
+        raise
+    except Exception as ex:
+        raise EvaluationError(ex, k)
+    finally:
+        # budget.steps is ahead of steps if a callback has been interrupted.
+        budget.steps = max(steps, budget.steps)
+        budget.cells += cells - budget.arg_cells # the argument cells
+        budget.closures, budget.arg_cells = closures, cells
+        budget.peak_depth = peak
+        PORTS.output = output
 
-def apply_function(fun, arg, k, env):
+def _depth_after(k, k0, depth):
+    "Return the depth of k given that of k0, the continuation before it."
+    j, n = k, 0
+    while n < 3 and j is not k0 and j is not NOCONT:
+        j, n = j[2], n + 1
+    if j is k0:
+        return depth + n
+    n = 0                       # k is another continuation invoked.
+    while k is not NOCONT:
+        k, n = k[2], n + 1
+    return n
+
+def apply_function(fun, arg, k, env, jit=True):
     """Apply a function to arguments with a continuation.
     It returns (result, continuation, environment).
+    If jit is true, compile hot closures and call them compiled.
     """
     while True:
         if fun is CALLCC_OBJ:
-            k = _push_RESTORE_ENV(k, env)
+            k = _push_RESTORE_ENV(_push_restore_output(k), env)
             fun, arg = arg.car, Cell(k, NIL)
         elif fun is APPLY_OBJ:
             fun, arg = arg.car, arg.cdr.car
+        elif isinstance(fun, Intrinsic):
+            if fun.arity >= 0:
+                if len(arg) != fun.arity:
+                    raise TypeError('arity not matched: ' + str(fun) + ' and '
+                                    + _abbreviate(arg))
+            if fun.__class__ is Continuable:
+                return call_back(fun.fun(arg), k, env, jit)
+            return fun.fun(arg), k, env
+        elif isinstance(fun, Closure):
+            info, boxes = fun.info, ()
+            if info is not None:
+                if jit:
+                    compiled = info.jit
+                    if compiled is None:
+                        info.calls += 1
+                        if JIT_THRESHOLD and info.calls >= JIT_THRESHOLD:
+                            compiled = jit_compile(fun)
+                    if compiled:
+                        result = compiled(fun, arg)
+                        if result.__class__ is TailCall:
+                            fun, arg = result.fun, result.args
+                            continue
+                        elif result is not FALLBACK:
+                            return result, k, env
+                boxes = info.boxes
+            k = _push_RESTORE_ENV(k, env)
+            k = (BEGIN, fun.body, k)
+            e = fun.env
+            env = Environment(None, e.val or e, # marker of the frame top
+                              e.prepend_defs(fun.params, arg, boxes))
+            return None, k, env
+        elif isinstance(fun, tuple): # as a continuation
+            return arg.car, fun, env
+        elif fun is CHECKPOINT_OBJ:
+            if not (isinstance(arg, Cell) and arg.cdr is NIL and
+                    isinstance(arg.car, SchemeString)):
+                raise TypeError('checkpoint needs a file name: ' +
+                                _abbreviate(arg))
+            k = _push_RESTORE_ENV(k, env)
+            checkpoint(arg.car.string, k)
+            return False, k, env
         else:
-            break
-    if isinstance(fun, Intrinsic):
+            raise TypeError('not a function: ' + _abbreviate(fun) + ' with '
+                            + _abbreviate(arg))
+
+def call_back(result, k, env, jit=True):
+    """Make the Calls requested by a Continuable until it returns a result.
+    It returns (result, continuation, environment) as apply_function does.
+    Each Call of an Intrinsic is made directly; any other Call is made
+    with a continuation to resume the Continuable.
+    """
+    while result.__class__ is Call:
+        fun, arg = result.fun, result.args
+        if fun.__class__ is not Intrinsic:
+            return apply_function(fun, arg, (RESUME, result, k), env, jit)
         if fun.arity >= 0:
             if len(arg) != fun.arity:
                 raise TypeError('arity not matched: ' + str(fun) + ' and '
-                                + stringify(arg))
-        return fun.fun(arg), k, env
-    elif isinstance(fun, Closure):
-        k = _push_RESTORE_ENV(k, env)
-        k = (BEGIN, fun.body, k)
-        env = Environment(None, None, # marker of the frame top
-                          fun.env.prepend_defs(fun.params, arg))
-        return None, k, env
-    elif isinstance(fun, tuple): # as a continuation
-        return arg.car, fun, env
-    else:
-        raise TypeError('not a function: ' + stringify(fun) + ' with ' 
-                        + stringify(arg))
+                                + _abbreviate(arg))
+        result = result.step(fun.fun(arg), result.state)
+    return result, k, env
 
 def _push_RESTORE_ENV(k, env):
     if k is NOCONT or k[0] is not RESTORE_ENV: # unless tail call...
         k = (RESTORE_ENV, env, k)
     return k
 
+def _push_restore_output(k):
+    """Push a frame which restores the current output port, so that
+    a continuation invoked from with-output-to-string writes where it did.
+    """
+    port = PORTS.output
+    j = k[2] if k is not NOCONT and k[0] is RESTORE_ENV else k
+    if j is NOCONT or j[0] is not RESUME or \
+            j[1].step is not _restore_output or j[1].state is not port:
+        k = (RESUME, Call(None, NIL, _restore_output, port), k)
+    return k   # unless the same frame is there in a tail call of call/cc
+
+
+# Hooks: if set_hooks(hooks) is called, evaluate runs the metered evaluator
+# with them, which calls each of their methods that is not None:
+#   on_eval(exp, env) before each step of evaluating exp in env,
+#   on_apply(fun, args, depth) before applying fun to args,
+#   on_return(fun, value, depth) when the call of fun returns value,
+#   on_continuation_invoke(k, value) when a continuation k is invoked.
+# depth is the depth of the continuation at the call, the same for the
+# call and its return.  The call of a closure returns when the frame it
+# pushed is popped; a tail call in it returns as part of the call.
+
+class Hooks (object):
+    "Base of hooks of the evaluator, which do nothing"
+    on_eval = on_apply = on_return = on_continuation_invoke = None
+
+HOOKS = None                    # Hooks set, or None
+_NO_HOOKS = Hooks()
+
+def set_hooks(hooks):
+    "Set hooks, or None to remove them, and return the old ones."
+    global HOOKS
+    old, HOOKS = HOOKS, hooks
+    return old
+
+def _apply_metered(fun, arg, k, env, depth, hooks, frames, budget):
+    """Apply fun to arg as apply_function does, calling the hooks.
+    Record the frame pushed by a closure call to frames for on_return.
+    Each Call made by a Continuable counts as a step of the budget.
+    """
+    if hooks.on_apply is not None:
+        hooks.on_apply(fun, arg, depth)
+    if fun.__class__ is tuple:  # as a continuation
+        if hooks.on_continuation_invoke is not None:
+            hooks.on_continuation_invoke(fun, arg.car)
+        return arg.car, fun, env
+    k0 = k
+    f, a = fun, arg
+    while f is APPLY_OBJ:       # Find a Continuable applied by apply.
+        f, a = a.car, a.cdr.car
+    if f.__class__ is Continuable:
+        if f.arity >= 0:
+            if len(a) != f.arity:
+                raise TypeError('arity not matched: ' + str(f) + ' and '
+                                + _abbreviate(a))
+        exp = f.fun(a)
+        _count_cells(budget, f, exp, a)
+        exp, k, env = _call_back_metered(exp, k, env, depth, hooks, frames,
+                                         budget)
+    else:
+        exp, k, env = apply_function(fun, arg, k, env, False)
+        _count_cells(budget, f, exp, a)
+    if hooks.on_return is not None:
+        if k is k0:             # returned at once
+            hooks.on_return(fun, exp, depth)
+        elif k[0] is BEGIN and k[2][0] is RESTORE_ENV: # entered a closure
+            frame = k[2]
+            key = (id(frame[1]), id(frame[2]))
+            if key not in frames: # unless tail call...
+                frames[key] = (frame, fun)
+    return exp, k, env
+
+def _call_back_metered(result, k, env, depth, hooks, frames, budget):
+    """Do call_back(result, k, env, False), calling the hooks and counting
+    each Call as a step of the budget.
+    """
+    while result.__class__ is Call:
+        budget.steps += 1
+        if budget.max_steps is not None and budget.steps > budget.max_steps:
+            raise ResourceError('too many steps', budget)
+        if (budget.deadline is not None and budget.steps % 1024 == 0 and
+                time() > budget.deadline):
+            raise ResourceError('deadline exceeded', budget)
+        fun, arg = result.fun, result.args
+        if fun.__class__ is not Intrinsic:
+            return _apply_metered(fun, arg, (RESUME, result, k), env,
+                                  depth + 1, hooks, frames, budget)
+        if hooks.on_apply is not None:
+            hooks.on_apply(fun, arg, depth + 1)
+        if fun.arity >= 0:
+            if len(arg) != fun.arity:
+                raise TypeError('arity not matched: ' + str(fun) + ' and '
+                                + _abbreviate(arg))
+        value = fun.fun(arg)
+        _count_cells(budget, fun, value, arg)
+        if hooks.on_return is not None:
+            hooks.on_return(fun, value, depth + 1)
+        step, state = result.step, result.state
+        result = step(value, state)
+        _count_cells(budget, step, result, state)
+    return result, k, env
+
+class Coverage (Hooks):
+    """Hooks recording the pairs evaluated as forms.
+    report() shows the forms never evaluated in the forms evaluated.
+    """
+    def __init__(self):
+        self.seen = {}          # id -> each pair evaluated
+        self.roots = []         # pairs evaluated in the top-level env
+
+    def on_eval(self, exp, env):
+        if exp.__class__ is Cell and id(exp) not in self.seen:
+            self.seen[id(exp)] = exp
+            if env.val is None: # env is the top-level.
+                self.roots.append(exp)
+
+    def missed(self):
+        "Return the outermost forms never evaluated in the forms evaluated."
+        result, done = [], set()
+        stack = self.roots[::-1]
+        while stack:
+            x = stack.pop()
+            if id(x) in done:
+                continue
+            done.add(id(x))
+            if id(x) not in self.seen:
+                result.append(x)
+                continue
+            kar, j = x.car, x.cdr
+            if kar is QUOTE:
+                continue
+            elif kar is LAMBDA or kar.__class__ is LambdaInfo:
+                j = j.cdr       # the body
+            elif kar is DEFINE or kar is SETQ:
+                j = j.cdr       # the value
+            elif kar is IF or kar is BEGIN:
+                pass
+            else:
+                j = x
+            subforms = []
+            while isinstance(j, Cell):
+                if isinstance(j.car, Cell):
+                    subforms.append(j.car)
+                j = j.cdr
+            stack.extend(reversed(subforms))
+        return result
+
+    def report(self):
+        "Return a report of the forms never evaluated."
+        missed = self.missed()
+        ss = ['Coverage: %d forms evaluated, %d never evaluated' %
+              (len(self.seen), len(missed))]
+        for x in missed:
+            ss.append('  ' + _abbreviate(x))
+        return '\n'.join(ss)
+
+class Tracer (Hooks):
+    """Hooks printing each call of a closure and its return indented
+    by the nesting of the calls; also those of Intrinsics if intrinsics.
+    A tail call is printed but returns as part of the call it is in.
+    """
+    def __init__(self, file=None, intrinsics=False):
+        self.file, self.intrinsics = file, intrinsics
+        self.depths = []        # depth of each call not returned yet
+
+    def on_apply(self, fun, args, depth):
+        if not (isinstance(fun, Closure) or self.intrinsics):
+            return
+        depths = self.depths
+        while depths and depths[-1] >= depth: # The calls have escaped.
+            depths.pop()
+        print('  ' * len(depths) +
+              _abbreviate(Cell(_procedure_name(fun), args)),
+              file=self.file or stderr)
+        if isinstance(fun, Closure):
+            if not (depths and depths[-1] + 1 == depth): # unless tail call
+                depths.append(depth)
+
+    def on_return(self, fun, value, depth):
+        if not (isinstance(fun, Closure) or self.intrinsics):
+            return
+        depths = self.depths
+        while depths and depths[-1] > depth:
+            depths.pop()
+        if depths and depths[-1] == depth and isinstance(fun, Closure):
+            depths.pop()
+        print('  ' * len(depths) + '=> ' + _abbreviate(value),
+              file=self.file or stderr)
+
+    def on_continuation_invoke(self, k, value):
+        print('  ' * len(self.depths) + '#<continuation> ' +
+              _abbreviate(value), file=self.file or stderr)
+
+def _procedure_name(fun):
+    "Return the symbol bound to fun in its env, or fun itself if none."
+    if isinstance(fun, Closure):
+        for e in fun.env:
+            if e.val is fun or (e.__class__ is Boxed and e.val.val is fun):
+                return e.sym
+    elif isinstance(fun, Intrinsic):
+        return intern(fun.name)
+    return fun
+
 
+# Tiered JIT: a closure body called JIT_THRESHOLD times is translated into
+# a Python function if it is made of constants, variables, quote, if,
+# begin, set! of variables, calls of Intrinsics (and of itself), and calls
+# of other functions in tail position.  Self tail calls become a while
+# loop; tail calls of other functions are returned as TailCalls.  Non-tail
+# self calls become Python recursion, allowed only in a body without side
+# effects, so that the call can fall back to the evaluator at any time.
+
+JIT_THRESHOLD = 100             # 0 disables the JIT.
+JIT_STATS = []          # [form, LambdaInfo, note, calls, source] of each try
+
+class TailCall (object):
+    "Call of fun with args in tail position returned by a compiled body"
+    __slots__ = ('fun', 'args')
+
+    def __init__(self, fun, args):
+        self.fun, self.args = fun, args
+
+class _FallbackClass:
+    def __str__(self):
+        return '#<fallback>'
+
+FALLBACK = _FallbackClass()     # Returned if the call must be interpreted.
+
+class _NotCompilable (Exception):
+    pass
+
+class _Bailout (Exception):
+    pass
+
+class _Unbound (object):
+    "Placeholder of a variable not bound yet"
+    __slots__ = ('sym',)
+
+    def __init__(self, sym):
+        self.sym = sym
+
+    @property
+    def val(self):
+        raise NameError(self.sym)
+
+def _lookup(env, sym):
+    "Return the binding (or the Box) of sym in env, or an _Unbound."
+    try:
+        return env.look_for(sym)
+    except NameError:
+        return _Unbound(sym)
+
+def _bail():
+    raise _Bailout()
+
+def _non_tail(result):
+    "Return the result of a non-tail self call unless it is a TailCall."
+    if result.__class__ is TailCall:
+        raise _Bailout()
+    return result
+
+# Python templates of the Intrinsics inlined into compiled bodies
+_INLINE = dict((_intrinsic(name), template) for name, template in (
+    ('+', '(%s + %s)'), ('-', '(%s - %s)'), ('*', '(%s * %s)'),
+    ('<', '(%s < %s)'), ('=', '(%s == %s)'), ('car', '%s.car'),
+    ('cdr', '%s.cdr'), ('cons', 'Cell(%s, %s)'), ('eq?', '(%s is %s)'),
+    ('pair?', 'isinstance(%s, Cell)'), ('null?', '(%s is NIL)'),
+    ('not', '(%s is False)')))
+
+_EQ = _intrinsic('eq?')
+
+# Intrinsics without side effects
+_PURE = frozenset(_intrinsic(name) for name in (
+    '+', '-', '*', '<', '=', 'number?', 'car', 'cdr', 'cons', 'eq?',
+    'pair?', 'null?', 'not', 'list', 'symbol?', 'eof-object?', 'equal?',
+    'reverse', 'append'))
+
+class _Compiler (object):
+    "Translator of the body of a closure into a Python function"
+
+    def __init__(self, fun):
+        self.fun = fun
+        self.vars = {}          # param -> Python local variable
+        self.nodes = {}         # free variable -> (Python variable, value)
+        self.consts = {}        # Python variable -> constant
+        self.guards = []        # (node variable, Intrinsic variable)
+        self.pure = True        # Does the body have no side effects?
+        self.recursive = False  # Does the body call itself in non-tail?
+        self.assigned = set()   # free variables assigned by set!
+        self.lines = []
+        j = fun.params
+        while isinstance(j, Cell):
+            if not isinstance(j.car, str) or j.car in self.vars:
+                raise _NotCompilable('bad parameters')
+            self.vars[j.car] = 'v%d' % len(self.vars)
+            j = j.cdr
+        if j is not NIL:
+            raise _NotCompilable('bad parameters')
+
+    def const(self, value, named=False):
+        "Return a Python expression of value, an int literal unless named."
+        if (isinstance(value, (int, long)) and not isinstance(value, bool) and
+                not named):
+            return repr(value)
+        name = 'c%d' % len(self.consts)
+        self.consts[name] = value
+        return name
+
+    def node(self, sym):
+        "Return (Python expression of the binding of sym, its value)."
+        if sym not in self.nodes:
+            try:
+                value = self.fun.env.look_for(sym).val
+            except NameError:
+                value = None
+            self.nodes[sym] = ('n%d' % len(self.nodes), value)
+        return self.nodes[sym]
+
+    def var(self, sym):
+        "Return a Python expression of the value of sym."
+        if sym in self.vars:
+            return self.vars[sym]
+        return self.node(sym)[0] + '.val'
+
+    def callee(self, exp):
+        "Classify an operator as 'self', 'intrinsic' or 'other'."
+        if isinstance(exp, str) and exp not in self.vars:
+            value = self.node(exp)[1]
+            if value is self.fun:
+                return 'self'
+            elif value.__class__ is Intrinsic:
+                return 'intrinsic'
+        return 'other'
+
+    def args(self, exp):
+        "Return the argument expressions of a call as a list."
+        result, j = [], exp.cdr
+        while isinstance(j, Cell):
+            result.append(j.car)
+            j = j.cdr
+        if j is not NIL:
+            raise _NotCompilable('improper call')
+        return result
+
+    def is_pure(self, exp):
+        "Does exp have no side effects?  (exp is compilable.)"
+        stack = [exp]
+        while stack:
+            exp = stack.pop()
+            if isinstance(exp, Cell):
+                kar = exp.car
+                if kar is QUOTE:
+                    continue
+                elif kar is SETQ:
+                    return False
+                elif kar is not IF and kar is not BEGIN:
+                    kind = self.callee(kar)
+                    if kind == 'intrinsic':
+                        if self.node(kar)[1] not in _PURE:
+                            return False
+                    elif kind != 'self':
+                        return False
+                j = exp.cdr
+                while isinstance(j, Cell):
+                    stack.append(j.car)
+                    j = j.cdr
+        return True
+
+    def list_of(self, exps):
+        ss = [self.expr(e) for e in exps]
+        if sum(1 for e in exps if not self.is_pure(e)) > 1:
+            raise _NotCompilable('side effects in arguments')
+        return ''.join('Cell(%s, ' % e for e in ss) + 'NIL' + ')' * len(ss)
+
+    def expr(self, exp):
+        "Return a Python expression of exp in non-tail position."
+        if isinstance(exp, str):
+            return self.var(exp)
+        elif not isinstance(exp, Cell):
+            return self.const(exp)
+        kar = exp.car
+        if kar is QUOTE:
+            return self.const(exp.cdr.car)
+        elif kar is IF:
+            a = self.args(exp)
+            return '(%s if %s is not False else %s)' % (
+                self.expr(a[1]), self.expr(a[0]),
+                self.expr(a[2]) if len(a) > 2 else 'None')
+        elif kar is BEGIN:
+            return '(%s,)[-1]' % ', '.join(self.expr(e)
+                                           for e in self.args(exp))
+        elif kar is LAMBDA or kar.__class__ is LambdaInfo:
+            raise _NotCompilable('lambda')
+        elif kar is DEFINE:
+            raise _NotCompilable('define')
+        elif kar is SETQ:
+            raise _NotCompilable('set! in an expression')
+        args = self.args(exp)
+        kind = self.callee(kar)
+        if kind == 'intrinsic':
+            return self.intrinsic_call(kar, args)
+        elif kind == 'self' and len(args) == len(self.vars):
+            self.recursive = True
+            ss = [self.expr(e) for e in args]
+            return '(_non_tail(run(%s)) if %s is fun else _bail())' % (
+                ', '.join(ss), self.var(kar))
+        raise _NotCompilable('non-tail call of ' + _abbreviate(kar))
+
+    def operand(self, exp):
+        "Return a Python expression of exp, naming its value if a constant."
+        if isinstance(exp, Cell) and exp.car is QUOTE:
+            return self.const(exp.cdr.car, True)
+        elif not isinstance(exp, (str, Cell)):
+            return self.const(exp, True)
+        return self.expr(exp)
+
+    def intrinsic_call(self, sym, args):
+        name, fun = self.node(sym)
+        if fun.arity >= 0 and fun.arity != len(args):
+            raise _NotCompilable('arity of ' + sym)
+        g = 'g%d' % len(self.guards)
+        self.guards.append((name, g))
+        self.consts[g] = fun
+        if fun not in _PURE:
+            self.pure = False
+        if fun in _INLINE and len(args) == fun.arity:
+            if sum(1 for e in args if not self.is_pure(e)) > 1:
+                raise _NotCompilable('side effects in arguments')
+            if fun is _EQ:      # Python warns of "is" with a literal.
+                return _INLINE[fun] % tuple(self.operand(e) for e in args)
+            return _INLINE[fun] % tuple(self.expr(e) for e in args)
+        return '%s.fun(%s)' % (g, self.list_of(args))
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def stmt(self, exp, indent):
+        "Emit statements of exp whose value is discarded."
+        if isinstance(exp, Cell) and exp.car is SETQ:
+            self.pure = False
+            sym, value = exp.cdr.car, exp.cdr.cdr.car
+            if not isinstance(sym, str):
+                raise _NotCompilable('bad set!')
+            self.assigned.add(sym)
+            target = self.vars.get(sym) or self.node(sym)[0] + '.val'
+            self.emit(indent, '%s = %s' % (target, self.expr(value)))
+        elif isinstance(exp, Cell) and exp.car is BEGIN:
+            for e in self.args(exp):
+                self.stmt(e, indent)
+        elif isinstance(exp, Cell) and exp.car is IF:
+            a = self.args(exp)
+            self.emit(indent, 'if %s is not False:' % self.expr(a[0]))
+            self.stmt(a[1], indent + 1)
+            if len(a) > 2:
+                self.emit(indent, 'else:')
+                self.stmt(a[2], indent + 1)
+        else:
+            self.emit(indent, self.expr(exp))
+
+    def tail(self, exp, indent):
+        "Emit statements which return the value of exp or continue."
+        kar = exp.car if isinstance(exp, Cell) else None
+        if kar is BEGIN:
+            a = self.args(exp)
+            if not a:
+                raise _NotCompilable('empty begin')
+            for e in a[:-1]:
+                self.stmt(e, indent)
+            self.tail(a[-1], indent)
+        elif kar is IF:
+            a = self.args(exp)
+            self.emit(indent, 'if %s is not False:' % self.expr(a[0]))
+            self.tail(a[1], indent + 1)
+            if len(a) > 2:
+                self.tail(a[2], indent)
+            else:
+                self.emit(indent, 'return None')
+        elif kar is SETQ:
+            self.stmt(exp, indent)
+            self.emit(indent, 'return None')
+        elif (kar is None or kar is QUOTE or kar is LAMBDA or kar is DEFINE
+              or kar.__class__ is LambdaInfo or
+              self.callee(kar) == 'intrinsic'):
+            self.emit(indent, 'return ' + self.expr(exp))
+        else:                   # a call of a non-intrinsic function
+            args = self.args(exp)
+            self.emit(indent, 'f = ' + self.expr(kar))
+            if self.callee(kar) == 'self' and len(args) == len(self.vars):
+                self.emit(indent, 'if f is fun:')
+                if args:
+                    self.emit(indent + 1, '%s = %s' % (
+                        ', '.join(self.params()),
+                        ', '.join(self.expr(e) for e in args)))
+                self.emit(indent + 1, 'continue')
+            self.emit(indent, 'return TailCall(f, %s)' % self.list_of(args))
+
+    def params(self):
+        "Return the Python local variables of the params in order."
+        return ['v%d' % i for i in range(len(self.vars))]
+
+    def compile(self):
+        "Return a Python function of (closure, arguments) for the closure."
+        body = self.fun.body
+        forms = []
+        while isinstance(body, Cell):
+            forms.append(body.car)
+            body = body.cdr
+        if not forms:
+            raise _NotCompilable('empty body')
+        self.lines = []
+        for e in forms[:-1]:
+            self.stmt(e, 2)
+        self.tail(forms[-1], 2)
+        if self.recursive and not self.pure:
+            raise _NotCompilable('non-tail self call with side effects')
+        guarded = set(name for name, _ in self.guards)
+        for sym in self.assigned:
+            if sym in self.nodes and self.nodes[sym][0] in guarded:
+                raise _NotCompilable('set! of a built-in function')
+        params = self.params()
+        src = ['def entry(fun, arg):', '    env = fun.env']
+        for sym, (name, _) in self.nodes.items():
+            src.append('    %s = _lookup(env, %s)' % (name, self.const(sym)))
+        for name, g in self.guards:
+            src.append('    if %s.val is not %s: return FALLBACK' % (name, g))
+        if params:
+            src.append('    try:')
+            src.append('        a = arg')
+            for v in params:
+                src.append('        %s = a.car; a = a.cdr' % v)
+            src.append('    except AttributeError:')
+            src.append('        a = None')
+            src.append('    if a is not NIL:')
+        else:
+            src.append('    if arg is not NIL:')
+        src.append('        env.prepend_defs(fun.params, arg)')
+        if self.recursive:
+            src.append('    def run(%s):' % ', '.join(params))
+            src.append('        while True:')
+            src.extend('    ' + line for line in self.lines)
+            src.append('    try:')
+            src.append('        return run(%s)' % ', '.join(params))
+            src.append('    except (_Bailout, RuntimeError):')
+            src.append('        return FALLBACK')
+        else:
+            src.append('    while True:')
+            src.extend(self.lines)
+        source = '\n'.join(src) + '\n'
+        namespace = dict(self.consts)
+        namespace.update(Cell=Cell, NIL=NIL, TailCall=TailCall,
+                         FALLBACK=FALLBACK, _lookup=_lookup, _bail=_bail,
+                         _non_tail=_non_tail, _Bailout=_Bailout)
+        exec(compile(source, '<jit>', 'exec'), namespace)
+        return namespace['entry'], source
+
+def jit_compile(fun):
+    """Compile the body of a closure and cache the result in its LambdaInfo.
+    Return the compiled function, or False if it is not compilable.
+    """
+    info = fun.info
+    form = _abbreviate(Cell(LAMBDA, Cell(fun.params, fun.body)))
+    try:
+        compiled, source = _Compiler(fun).compile()
+        entry = [form, info, 'compiled', 0, source]
+        def counted(fun, arg):
+            entry[3] += 1
+            result = compiled(fun, arg)
+            if result is FALLBACK:
+                entry[2] = 'fell back'
+                info.jit = False
+            return result
+        info.jit = counted
+    except Exception as ex:     # _NotCompilable or a malformed expression
+        entry = [form, info, 'not compiled: ' + str(ex), 0, None]
+        info.jit = False
+    JIT_STATS.append(entry)
+    return info.jit
+
+def jit_stats():
+    "Return a report of the JIT as a string."
+    ss = ['JIT: threshold %d, %d hot lambda expressions' %
+          (JIT_THRESHOLD, len(JIT_STATS))]
+    for form, info, note, calls, _ in JIT_STATS:
+        ss.append('  %s\n    %s; %d calls interpreted, %d calls compiled' %
+                  (form, note, info.calls, calls))
+    return '\n'.join(ss)
+
+
 def split_string_into_tokens(source_string):
     "split_string_into_tokens('(a 1)') => ['(', 'a', '1', ')']"
     result = []
@@ -372,28 +2893,75 @@ def split_string_into_tokens(source_string):
 def read_from_tokens(tokens):
     """Read an expression from a list of token strings.
     The list will be left with the rest of token strings, if any.
+    If the tokens run out, IndexError is raised with the list untouched.
     """
-    token = tokens.pop(0)
-    if token == '(':
-        y = z = Cell(NIL, NIL)
-        while tokens[0] != ')':
-            if tokens[0] == '.':
-                tokens.pop(0)
-                y.cdr = read_from_tokens(tokens)
-                if tokens[0] != ')':
-                    raise SyntaxError(') is expected')
+    exp, i = _parse(tokens, 0, [])
+    if exp is _MORE:
+        raise IndexError('tokens have run out')
+    del tokens[:i]
+    return exp
+
+def _parse(tokens, i, stack):
+    """Parse tokens from the index i on, continuing the lists on the stack.
+    Return the expression read and the index after it, or _MORE and the
+    length of tokens with the stack left with the lists being read.
+    """
+    n = len(tokens)
+    while i < n:
+        token = tokens[i]
+        i += 1
+        top = stack[-1] if stack else None
+        if top is not None and top is not QUOTE and top[2] == _DOTTED:
+            if token != ')':
+                raise _syntax_error(') is expected', i)
+        if token == '(':
+            z = Cell(NIL, NIL)
+            stack.append([z, z, _ELEMENTS])
+            continue
+        elif token == ')':
+            if top is None or top is QUOTE or top[2] == _AFTER_DOT:
+                raise _syntax_error('unexpected )', i)
+            stack.pop()
+            exp = top[0].cdr
+        elif token == "'":
+            stack.append(QUOTE)
+            continue
+        elif token == '.' and top is not None and top is not QUOTE:
+            top[2] = _AFTER_DOT
+            continue
+        else:
+            exp = _read_atom(token)
+        while True:          # Put exp into the enclosing structure.
+            if not stack:
+                return exp, i
+            top = stack[-1]
+            if top is QUOTE:
+                stack.pop()
+                exp = Cell(QUOTE, Cell(exp, NIL)) # 'e => (quote e)
+            else:
+                if top[2] == _ELEMENTS:
+                    top[1].cdr = Cell(exp, NIL)
+                    top[1] = top[1].cdr
+                else:
+                    top[1].cdr = exp
+                    top[2] = _DOTTED
                 break
-            e = read_from_tokens(tokens)
-            y.cdr = Cell(e, NIL)
-            y = y.cdr
-        tokens.pop(0)
-        return z.cdr
-    elif token == ')':
-        raise SyntaxError('unexpected )')
-    elif token == "'":
-        e = read_from_tokens(tokens)
-        return Cell(QUOTE, Cell(e, NIL)) # 'e => (quote e)
-    elif token == '#f':
+    return _MORE, i
+
+_MORE = object()                # returned by _parse when tokens run out
+
+def _syntax_error(message, index):
+    "Make a SyntaxError whose offset is the index after the bad token."
+    ex = SyntaxError(message)
+    ex.offset = index
+    return ex
+
+# States of each list being read in _parse
+_ELEMENTS, _AFTER_DOT, _DOTTED = 0, 1, 2
+
+def _read_atom(token):
+    "Convert a token other than parentheses and quote to an expression."
+    if token == '#f':
         return False
     elif token == '#t':
         return True
@@ -408,50 +2976,1097 @@ def read_from_tokens(tokens):
             except ValueError:
                 return intern(token) # as a symbol
 
+# Derived expression types defined as macros
+_PRELUDE = """
+(define-syntax let
+  (syntax-rules ()
+    ((_ ((v e) ...) b1 b2 ...) ((lambda (v ...) b1 b2 ...) e ...))
+    ((_ tag ((v e) ...) b1 b2 ...)
+     ((letrec ((tag (lambda (v ...) b1 b2 ...))) tag) e ...))))
+(define-syntax let*
+  (syntax-rules ()
+    ((_ () b1 b2 ...) (let () b1 b2 ...))
+    ((_ ((v e) rest ...) b1 b2 ...) (let ((v e)) (let* (rest ...) b1 b2 ...)))))
+(define-syntax letrec
+  (syntax-rules ()
+    ((_ ((v e) ...) b1 b2 ...) ((lambda () (define v e) ... b1 b2 ...)))))
+(define-syntax letrec*
+  (syntax-rules ()
+    ((_ ((v e) ...) b1 b2 ...) ((lambda () (define v e) ... b1 b2 ...)))))
+(define-syntax and
+  (syntax-rules ()
+    ((_) #t)
+    ((_ e) e)
+    ((_ e1 e2 ...) (if e1 (and e2 ...) #f))))
+(define-syntax or
+  (syntax-rules ()
+    ((_) #f)
+    ((_ e) e)
+    ((_ e1 e2 ...) (let ((t e1)) (if t t (or e2 ...))))))
+(define-syntax cond
+  (syntax-rules (else =>)
+    ((_ (else e1 e2 ...)) (begin e1 e2 ...))
+    ((_ (test => f) c ...) (let ((t test)) (if t (f t) (cond c ...))))
+    ((_ (test) c ...) (or test (cond c ...)))
+    ((_ (test e1 e2 ...) c ...) (if test (begin e1 e2 ...) (cond c ...)))
+    ((_) #f)))
+(define-syntax delay
+  (syntax-rules () ((_ e) (%delay (lambda () e)))))
+(define-syntax delay-force
+  (syntax-rules () ((_ e) (%delay-force (lambda () e)))))
+(define-syntax cons-stream
+  (syntax-rules () ((_ a b) (cons a (delay b)))))
+(define-syntax when
+  (syntax-rules ()
+    ((_ test e1 e2 ...) (if test (begin e1 e2 ...)))))
+(define-syntax unless
+  (syntax-rules ()
+    ((_ test e1 e2 ...) (if test #f (begin e1 e2 ...)))))
+"""
+
+_tokens = split_string_into_tokens(_PRELUDE)
+while _tokens:
+    expand(read_from_tokens(_tokens))
+del _tokens
+
+LOADING = []            # tokens left in the files being loaded, innermost last
+
 def load(file_name):
     "Load a source code from a file."
     with open(file_name) as rf:
         source_string = rf.read()
-    tokens = split_string_into_tokens(source_string)
-    while tokens:
-        exp = read_from_tokens(tokens)
-        evaluate(exp)
+    _load_tokens(split_string_into_tokens(source_string))
+
+def _load_tokens(tokens):
+    LOADING.append(tokens)
+    try:
+        while tokens:
+            exp = read_from_tokens(tokens)
+            evaluate(exp)
+    finally:
+        LOADING.pop()
+
+
+# Checkpoints: (checkpoint "file") saves its continuation together with
+# the top-level environment, the macros and the tokens left in the files
+# being loaded, and returns #f.  resume("file") restores them and goes on
+# as if the checkpoint returned #t.  The objects are flattened without
+# recursion into a table of entries [kind field...], which is written by
+# marshal.  Python functions are saved by name, or by the name and the line
+# of their code in this file with the values of their closures.
+
+_UNSET = object()               # value of a slot not set yet
+_BUILTINS = dict((b.sym, b.val) for b in GLOBAL_ENV
+                 if isinstance(b.val, Intrinsic))
+_NAMED = dict((id(v), ['builtin', sym]) for sym, v in _BUILTINS.items())
+for _name in ('NIL', 'APPLY_OBJ', 'CALLCC_OBJ', 'CHECKPOINT_OBJ', 'FORCE',
+              'FALLBACK', '_UNSET'):
+    _NAMED[id(globals()[_name])] = ['global', _name]
+del _name
+_MEMBER = type(Cell.car)
+_WRAPPER = type(Cell.car.__set__)
+_CODES = {}                     # (name, first line) => code in this file
+_replace = getattr(os, 'replace', os.rename) # os.rename for Python 2
+
+def _source_digest():
+    "Return the digest of this file, which checkpoints depend on."
+    from hashlib import sha1
+    file_name = __file__[:-1] if __file__.endswith('c') else __file__
+    with open(file_name, 'rb') as rf:
+        return sha1(rf.read()).hexdigest()
+
+def _slots(cls):
+    "Return the names of the slots of instances of cls."
+    result = []
+    for c in reversed(cls.__mro__):
+        result.extend(c.__dict__.get('__slots__', ()))
+    return result
+
+def _is_global(x):
+    name = getattr(x, '__name__', None)
+    return name is not None and globals().get(name) is x
+
+def _cp_entry(x, ref):
+    "Return the entry of x as a Python list, calling ref for the fields."
+    if x.__class__ is Cell:
+        return ['cell', ref(x.car), ref(x.cdr)]
+    elif id(x) in _NAMED:
+        return _NAMED[id(x)]
+    elif x is GLOBAL_ENV:
+        return ['top', ref(x.sym), ref(x.val), ref(x.next)]
+    elif x is None or isinstance(x, (bool, int, long, float, str)):
+        return ['atom', x]
+    elif isinstance(x, SchemeString):
+        return ['string', x.string]
+    elif isinstance(x, (bytearray, memoryview)):
+        return ['bytes', bytes(bytearray(x))]
+    elif x.__class__ in (tuple, list, frozenset, set):
+        return [x.__class__.__name__] + [ref(e) for e in x]
+    elif x.__class__ is dict:
+        return ['dict'] + [ref(e) for kv in x.items() for e in kv]
+    elif isinstance(x, EOFError):
+        return ['eof']
+    elif isinstance(x, StringIO):
+        return ['stringio', x.getvalue(), x.tell()]
+    elif isinstance(x, type) and issubclass(x, Record):
+        return ['record-type', x.name] + list(x.fields)
+    elif isinstance(x, (_MEMBER, _WRAPPER)):
+        owner = x.__objclass__ if isinstance(x, _MEMBER) else x.__self__
+        return ['attr', ref(owner), x.__name__]
+    elif x.__class__.__name__ == 'module':
+        return ['module', x.__name__]
+    elif getattr(x, '__module__', None) == __name__:
+        if _is_global(x):
+            return ['global', x.__name__]
+        elif isinstance(x, FunctionType):
+            code = x.__code__
+            cells = [c.cell_contents for c in x.__closure__ or ()]
+            return (['closure', code.co_name, code.co_firstlineno,
+                     ref(x.__defaults__)] + [ref(e) for e in cells])
+        elif not hasattr(x, '__dict__') or isinstance(x, Record):
+            values = [getattr(x, s, _UNSET) for s in _slots(x.__class__)]
+            if x.__class__ is LambdaInfo and values[-1]:
+                values[-1] = None   # Compile it again if it was compiled.
+            return ['object', ref(x.__class__)] + [ref(e) for e in values]
+    elif hasattr(x, '__module__') and hasattr(x, '__name__'):
+        name = getattr(x, '__qualname__', x.__name__)
+        obj = import_module(x.__module__)
+        for attr in name.split('.'):
+            obj = getattr(obj, attr, None)
+        if obj is x:
+            return ['import', x.__module__, name]
+    raise TypeError('checkpoint: cannot save ' + _abbreviate(x))
+
+def _flatten(root):
+    "Return the entries of the objects reachable from root."
+    entries, index, stack = [], {}, []
+    def ref(x):
+        "Return the index of the entry of x."
+        i = index.get(id(x))
+        if i is None:
+            i = index[id(x)] = len(entries)
+            entries.append(None)
+            stack.append(x)
+        return i
+    ref(root)
+    while stack:
+        x = stack.pop()
+        entries[index[id(x)]] = _cp_entry(x, ref)
+    return entries
+
+def _code(name, line):
+    "Find the code of a function in this file."
+    if not _CODES:
+        stack = [v.__code__ for v in globals().values()
+                 if isinstance(v, FunctionType)]
+        for v in list(globals().values()):
+            if isinstance(v, type) and v.__module__ == __name__:
+                stack.extend(f.__code__ for f in vars(v).values()
+                             if isinstance(f, FunctionType))
+        while stack:
+            code = stack.pop()
+            _CODES[code.co_name, code.co_firstlineno] = code
+            stack.extend(c for c in code.co_consts if isinstance(c, CodeType))
+    return _CODES[name, line]
+
+def _cell(value):
+    "Make a cell of a closure."
+    return (lambda: value).__closure__[0]
+
+# Kinds of the entries which are made whole after their fields
+_IMMUTABLES = frozenset(('tuple', 'frozenset', 'closure', 'attr'))
+
+def _unflatten(entries):
+    "Make the objects of the entries; return them in a list."
+    objs = [_UNSET] * len(entries)
+    for i, e in enumerate(entries): # Make the objects without fields.
+        kind = e[0]
+        if kind == 'atom':
+            objs[i] = intern(e[1]) if isinstance(e[1], str) else e[1]
+        elif kind == 'string':
+            objs[i] = SchemeString(e[1])
+        elif kind == 'bytes':
+            objs[i] = bytearray(e[1])
+        elif kind == 'top':
+            objs[i] = GLOBAL_ENV
+        elif kind == 'builtin':
+            objs[i] = _BUILTINS[e[1]]
+        elif kind == 'global':
+            objs[i] = globals()[e[1]]
+        elif kind == 'eof':
+            objs[i] = EOFError()
+        elif kind == 'stringio':
+            objs[i] = StringIO(e[1])
+            objs[i].seek(e[2])
+        elif kind == 'record-type':
+            objs[i] = _record_class(e[1], e[2:])
+        elif kind == 'module':
+            objs[i] = import_module(e[1])
+        elif kind == 'import':
+            obj = import_module(e[1])
+            for attr in e[2].split('.'):
+                obj = getattr(obj, attr)
+            objs[i] = obj
+    for i, e in enumerate(entries): # Make the shells of mutable objects.
+        kind = e[0]
+        if kind == 'cell':
+            objs[i] = Cell.__new__(Cell)
+        elif kind == 'list':
+            objs[i] = []
+        elif kind == 'dict':
+            objs[i] = {}
+        elif kind == 'set':
+            objs[i] = set()
+        elif kind == 'object':
+            cls = objs[e[1]]
+            objs[i] = cls.__new__(cls)
+    for i, e in enumerate(entries): # Make the immutable objects.
+        if e[0] in _IMMUTABLES and objs[i] is _UNSET:
+            stack, making = [i], set()
+            while stack:
+                j = stack[-1]
+                e = entries[j]
+                refs = e[3:] if e[0] == 'closure' else e[1:2] \
+                    if e[0] == 'attr' else e[1:]
+                deps = [r for r in refs if objs[r] is _UNSET]
+                if deps:
+                    if j in making:
+                        raise ValueError('checkpoint: cyclic entry %d' % j)
+                    making.add(j)
+                    stack.extend(deps)
+                    continue
+                stack.pop()
+                if objs[j] is not _UNSET:
+                    continue
+                kind, fields = e[0], [objs[r] for r in refs]
+                if kind == 'tuple':
+                    objs[j] = tuple(fields)
+                elif kind == 'frozenset':
+                    objs[j] = frozenset(fields)
+                elif kind == 'attr':
+                    objs[j] = getattr(fields[0], e[2])
+                else:
+                    objs[j] = FunctionType(
+                        _code(e[1], e[2]), globals(), e[1], fields[0],
+                        tuple(_cell(v) for v in fields[1:]) or None)
+    for i, e in enumerate(entries): # Fill the mutable objects.
+        kind, x = e[0], objs[i]
+        if kind == 'cell' or kind == 'top':
+            for name, r in zip(_slots(x.__class__), e[1:]):
+                setattr(x, name, objs[r])
+        elif kind == 'list':
+            x.extend(objs[r] for r in e[1:])
+        elif kind == 'dict':
+            for j in range(1, len(e), 2):
+                x[objs[e[j]]] = objs[e[j + 1]]
+        elif kind == 'set':
+            x.update(objs[r] for r in e[1:])
+        elif kind == 'object':
+            for name, r in zip(_slots(x.__class__), e[2:]):
+                if objs[r] is not _UNSET:
+                    setattr(x, name, objs[r])
+    return objs
+
+def checkpoint(file_name, k):
+    "Save the continuation k and the global state to a file."
+    import marshal
+    global FRESH_NUMBERS
+    fresh = next(FRESH_NUMBERS)
+    FRESH_NUMBERS = count(fresh)
+    entries = _flatten((k, PORTS.output, TOP_LEVEL.macros, fresh,
+                        list(LOADING)))
+    data = marshal.dumps((_source_digest(), entries))
+    with open(file_name + '.tmp', 'wb') as wf:
+        wf.write(data)
+    _replace(file_name + '.tmp', file_name) # atomically
+
+def resume(file_name):
+    """Restore the state saved by (checkpoint file_name) and continue the
+    computation with #t as the result of the checkpoint.
+    """
+    import marshal
+    global FRESH_NUMBERS
+    with open(file_name, 'rb') as rf:
+        digest, entries = marshal.loads(rf.read())
+    if digest != _source_digest():
+        raise ValueError('checkpoint made by another scm.py: ' + file_name)
+    k, output, macros, fresh, loading = _unflatten(entries)[0]
+    TOP_LEVEL.macros.clear()
+    TOP_LEVEL.macros.update(macros)
+    FRESH_NUMBERS = count(fresh)
+    PORTS.output = output
+    try:
+        evaluate(Cell(k, Cell(True, NIL)))
+    finally:
+        PORTS.output = None
+    for tokens in reversed(loading):
+        _load_tokens(tokens)
+
+class Reader (object):
+    """Incremental reader of expressions from a source of text.
+    read_chunk(n) returns the next text of at most n bytes, or '' at EOF.
+    The text is split into tokens line by line, and each token is parsed
+    only once; the lists being read are kept across lines.  Lines and
+    characters can be read from the same text, too.
+    """
+    __slots__ = ('read_chunk', 'text', 'pos', 'tokens', 'index', 'stack')
+    chunk_size = 65536
+
+    def __init__(self, read_chunk):
+        self.read_chunk = read_chunk
+        self.text, self.pos = '', 0 # text read and the position in it
+        self.tokens, self.index, self.stack = [], 0, []
+
+    def _fill(self):
+        "Append the next chunk to the text left; return False at EOF."
+        data = self.read_chunk(self.chunk_size)
+        if not data:
+            return False
+        self.text, self.pos = self.text[self.pos:] + data, 0
+        return True
+
+    def read_line(self):
+        "Return the next line with its newline, or '' at EOF."
+        while True:
+            i = self.text.find('\n', self.pos)
+            if i >= 0 or not self._fill():
+                end = len(self.text) if i < 0 else i + 1
+                line, self.pos = self.text[self.pos:end], end
+                return line
+
+    def read_char(self, peek=False):
+        "Return the next character, or '' at EOF."
+        if self.pos == len(self.text) and not self._fill():
+            return ''
+        c = self.text[self.pos]
+        if not peek:
+            self.pos += 1
+        return c
+
+    def read(self):
+        "Return the next expression, or an EOFError at EOF."
+        while True:
+            try:
+                exp, self.index = _parse(self.tokens, self.index, self.stack)
+            except SyntaxError as ex:
+                self.index = ex.offset  # Discard the tokens read so far.
+                del self.stack[:]
+                raise
+            if exp is not _MORE:
+                return exp
+            line = self.read_line()
+            if not line:
+                del self.stack[:]
+                return EOFError()
+            self.tokens, self.index = split_string_into_tokens(line), 0
+
+_decode_stdin = getincrementaldecoder('utf-8')().decode
+
+def _read_stdin(n):
+    "Read the standard input by at most n bytes as they arrive."
+    while True:
+        data = os.read(0, n)
+        if bytes is str:        # for Python 2
+            return data
+        text = _decode_stdin(data, not data)
+        if text or not data:
+            return text
+
+STDIN = None                    # Reader of the standard input in batch mode
+
+def use_batch_input(batch=None):
+    """Read the standard input without prompts through a Reader if batch,
+    or if the standard input is not a tty when batch is None.
+    """
+    global STDIN
+    if batch is None:
+        batch = not os.isatty(0)
+    STDIN = Reader(_read_stdin) if batch else None
 
 TOKENS = []
 
 def read_expression(prompt1='> ', prompt2='| '):
     "Read an expression."
+    if STDIN is not None:
+        return STDIN.read()
     while True:
-        old = TOKENS[:]
         try:
             return read_from_tokens(TOKENS)
         except IndexError:      # tokens have run out unexpectedly.
             try:
-                source_string = raw_input(prompt2 if old else prompt1)
+                source_string = raw_input(prompt2 if TOKENS else prompt1)
             except EOFError as ex:
                 return ex
-            TOKENS[:] = old
             TOKENS.extend(split_string_into_tokens(source_string))
         except SyntaxError:
             del TOKENS[:]       # Discard the erroneous tokens.
             raise
 
-def read_eval_print_loop():
-    "Repeat read-eval-print until End-of-File."
+def read_eval_print_loop(lock=None):
+    """Repeat read-eval-print until End-of-File.
+    If a lock is given, each evaluation is done while holding it.
+    """
     while True:
         try:
             exp = read_expression()
             if isinstance(exp, EOFError):
-                print('Goodbye')
+                if STDIN is None:
+                    print('Goodbye')
                 return
-            result = evaluate(exp)
+            if lock is None:
+                result = evaluate(exp)
+            else:
+                with lock:
+                    result = evaluate(exp)
             if result is not None:
                 print(stringify(result, True))
         except Exception as ex:
             print(ex)
 
+# REPL server: each connection is a session with its own copies of the
+# top-level bindings and the macros, and its own buffer of tokens.  Each
+# expression read is a request evaluated within a Budget; at most
+# `workers` requests are evaluated at a time.  A line ":stats" answers
+# the statistics in JSON.
+
+class ServerStats (object):
+    "Counts of sessions, requests and steps, and histograms of latencies"
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+    outcomes = ('ok', 'error', 'limit')
+
+    def __init__(self):
+        from threading import Lock
+        self.lock = Lock()
+        self.sessions = self.active = self.steps = self.max_steps = 0
+        n = len(self.bounds) + 1
+        self.latency = dict((o, [0] * n) for o in self.outcomes)
+
+    def add(self, outcome, seconds, steps):
+        "Count a request which took seconds and steps."
+        i = bisect_left(self.bounds, seconds * 1000)
+        with self.lock:
+            self.latency[outcome][i] += 1
+            self.steps += steps
+            self.max_steps = max(self.max_steps, steps)
+
+    def open(self, delta):
+        "Count a session opened (delta=1) or closed (delta=-1)."
+        with self.lock:
+            if delta > 0:
+                self.sessions += 1
+            self.active += delta
+
+    def to_json(self):
+        "Return the statistics as a JSON text of one line."
+        import json
+        with self.lock:
+            d = {'sessions': self.sessions, 'active': self.active,
+                 'requests': dict((o, sum(h))
+                                  for o, h in self.latency.items()),
+                 'steps': self.steps, 'max_steps': self.max_steps,
+                 'latency_ms': dict(self.latency,
+                                    le=list(self.bounds) + ['inf'])}
+        return json.dumps(d, sort_keys=True)
+
+def _top_level_copy(env=GLOBAL_ENV):
+    "Return a new top-level env with a copy of each binding of env."
+    top = e = Environment(None, None, None)
+    for b in env.next:
+        e.next = Environment(b.sym, b.val, None)
+        e = e.next
+    return top
+
+class _Session (object):
+    "Client of the REPL server with its own top-level env, macros and tokens"
+    __slots__ = ('server', 'connection', 'rfile', 'wfile', 'env', 'macros',
+                 'tokens', 'peeked', 'budget')
+
+    def __init__(self, server, connection):
+        self.server, self.connection = server, connection
+        self.rfile = connection.makefile('rb')
+        self.wfile = connection.makefile('wb')
+        self.macros = dict(MACROS)
+        self.env = env = _top_level_copy()
+        for name, arity, fun in (
+                ('read', 0, lambda x: self.read(self.budget)),
+                ('read-line', -1, self._intrinsic_read_line),
+                ('read-char', -1, self._intrinsic_read_char),
+                ('peek-char', -1, lambda x: self._intrinsic_read_char(
+                    x, True))):
+            env.next = Environment(intern(name), Intrinsic(name, arity, fun),
+                                   env.next)
+        self.tokens = []
+        self.peeked = ''        # the character peeked from the client
+        self.budget = None      # Budget of the request being evaluated
+
+    def read(self, budget=None):
+        """Read an expression from the client, or return EOFError at EOF.
+        With a budget, wait for the client until its deadline at most.
+        """
+        tokens = self.tokens
+        while True:
+            try:
+                return read_from_tokens(tokens)
+            except IndexError:  # tokens have run out unexpectedly.
+                line = self.read_line(budget)
+                if not line:
+                    return EOFError()
+                if not tokens and line.strip() == ':stats':
+                    self.reply(self.server.stats.to_json())
+                else:
+                    tokens.extend(split_string_into_tokens(line))
+            except SyntaxError:
+                del tokens[:]   # Discard the erroneous tokens.
+                raise
+
+    def read_line(self, budget=None):
+        "Read a line of text with its newline, or '' at EOF."
+        line, self.peeked = self.peeked, ''
+        if line != '\n':
+            data = self._read_line(budget)
+            line += data if bytes is str else data.decode('utf-8', 'replace')
+        return line
+
+    def read_char(self, peek=False, budget=None):
+        "Read a character, or '' at EOF."
+        c = self.peeked
+        if not c:
+            data = self._read_line(budget, 1)
+            if data and bytes is not str: # for Python 3
+                lead = data[0]  # Read the rest of a UTF-8 sequence.
+                n = (lead >= 0xC0) + (lead >= 0xE0) + (lead >= 0xF0)
+                if n:
+                    data += self._read_line(budget, n)
+                data = data.decode('utf-8', 'replace')
+            c = data
+        self.peeked = c if peek else ''
+        return c
+
+    def _intrinsic_read_line(self, x):
+        "(read-line [port]) reading the client if no port is given"
+        if x is not NIL:
+            return _read_line(x)
+        line = self.read_line(self.budget)
+        if not line:
+            return EOFError()
+        return SchemeString(line[:-1] if line.endswith('\n') else line)
+
+    def _intrinsic_read_char(self, x, peek=False):
+        "(read-char [port]) reading the client if no port is given"
+        if x is not NIL:
+            return _read_char(x, peek)
+        c = self.read_char(peek, self.budget)
+        return SchemeString(c) if c else EOFError()
+
+    def _read_line(self, budget, size=-1):
+        """Read a line of at most size bytes; if the deadline passes first,
+        stop reading for good.
+        """
+        import socket
+        deadline = None if budget is None else budget.deadline
+        if deadline is None:
+            return self.rfile.readline(size)
+        self.connection.settimeout(max(deadline - time(), 0.001))
+        try:
+            return self.rfile.readline(size)
+        except socket.timeout:  # The rest of the line, if any, is lost.
+            self.connection.shutdown(socket.SHUT_RD)
+            raise ResourceError('deadline exceeded while reading', budget)
+        finally:
+            self.connection.settimeout(None)
+
+    def reply(self, text):
+        """Send a response to the client.  It ends with a line '.', and
+        each line of text beginning with '.' is sent with another '.'.
+        """
+        lines = text[:-1].split('\n') if text.endswith('\n') else (
+            text.split('\n') if text else [])
+        self.send(''.join(('.' + s if s.startswith('.') else s) + '\n'
+                          for s in lines) + '.\n')
+
+    def send(self, text):
+        "Send a text to the client."
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.wfile.write(text)
+        self.wfile.flush()
+
+class ReplServer (object):
+    """REPL server over TCP, where address is (host, port), or over a Unix
+    domain socket, where address is its path.
+    Each request is limited to max_steps steps and timeout seconds.
+    """
+    def __init__(self, address, workers=4, max_steps=1000000, timeout=10.0):
+        try:
+            import SocketServer as socketserver # for Python 2
+        except ImportError:
+            import socketserver
+        from threading import Semaphore
+        if isinstance(address, tuple):
+            server = socketserver.ThreadingTCPServer(address, self.handle,
+                                                     False)
+            server.allow_reuse_address = True
+        else:
+            server = socketserver.ThreadingUnixStreamServer(
+                address, self.handle, False)
+        server.daemon_threads = True
+        try:
+            server.server_bind()
+            server.server_activate()
+        except EnvironmentError:
+            server.server_close()
+            raise
+        self.server, self.address = server, server.server_address
+        self.slots = Semaphore(workers)
+        self.max_steps, self.timeout = max_steps, timeout
+        self.stats = ServerStats()
+
+    def handle(self, connection, client_address, server):
+        "Run a session on a connection until the client closes it."
+        session = _Session(self, connection)
+        TOP_LEVEL.env, TOP_LEVEL.macros = session.env, session.macros
+        self.stats.open(1)
+        try:
+            while True:
+                try:
+                    exp = session.read()
+                except SyntaxError as ex:
+                    session.reply(str(ex))
+                    continue
+                if isinstance(exp, EOFError):
+                    return
+                session.reply(self.serve(exp, session))
+        except EnvironmentError: # The client has gone.
+            pass
+        finally:
+            self.stats.open(-1)
+            session.rfile.close()
+            try:
+                session.wfile.close()
+            except EnvironmentError:
+                pass
+
+    def serve(self, exp, session):
+        "Evaluate exp in a session and return the output and the result."
+        start = time()
+        out = StringIO()
+        with self.slots:
+            session.budget = budget = Budget(self.max_steps, None,
+                                             self.timeout)
+            PORTS.output = out
+            try:
+                result = evaluate(exp, session.env, budget)
+                text = '' if result is None else stringify(result, True)
+                outcome = 'ok'
+            except ResourceError as ex:
+                text, outcome = str(ex), 'limit'
+            except Exception as ex:
+                text, outcome = str(ex), 'error'
+            finally:
+                PORTS.output = None
+                session.budget = None
+        self.stats.add(outcome, time() - start, budget.steps)
+        output = out.getvalue()
+        if output and text and not output.endswith('\n'):
+            output += '\n'
+        return output + text
+
+    def serve_forever(self):
+        "Serve clients until shut down or interrupted."
+        self.server.serve_forever()
+
+    def shutdown(self):
+        "Stop serve_forever running in another thread."
+        self.server.shutdown()
+
+    def close(self):
+        "Close the listening socket (and remove it if it is a path)."
+        self.server.server_close()
+        if not isinstance(self.address, tuple):
+            os.remove(self.address)
+
+def serve(address, workers=4, max_steps=1000000, timeout=10.0):
+    """Run a REPL server until interrupted.  The address is a path of
+    a Unix domain socket if it has '/', or else [host:]port.
+    """
+    if '/' not in address:
+        host, _, port = address.rpartition(':')
+        address = (host or '127.0.0.1', int(port))
+    server = ReplServer(address, workers, max_steps, timeout)
+    print('Listening on', server.address, file=stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+# Watch mode: a Watcher loads a script form by form and remembers the
+# digest of the tokens, the names defined and the symbols mentioned of
+# each form.  When the file changes, it evaluates only the forms that are
+# new or mention a name evaluated again before them, in the file order.
+# A changed define updates its top-level binding in place, so that the
+# closures, even compiled ones, see the new value.
+
+class Watcher (object):
+    "Reloader of the changed top-level forms of a script"
+    interval = 0.5              # seconds between checks of the file
+
+    def __init__(self, file_name):
+        from threading import Lock
+        self.file_name = file_name
+        self.stamp = None       # (mtime, size) of the file loaded
+        self.forms = {}         # digest -> [(names, mentions)...]
+        self.lock = Lock()      # held while evaluating
+
+    def changed(self):
+        "Has the file changed since it was loaded?"
+        st = os.stat(self.file_name)
+        return (st.st_mtime, st.st_size) != self.stamp
+
+    def reload(self):
+        """Evaluate the forms which are new or depend on the names evaluated.
+        Return the number of the forms evaluated and that of all forms.
+        """
+        from hashlib import sha1
+        st = os.stat(self.file_name)
+        self.stamp = (st.st_mtime, st.st_size)
+        with open(self.file_name) as rf:
+            tokens = split_string_into_tokens(rf.read())
+        source, forms = tokens[:], []
+        while tokens:
+            start = len(source) - len(tokens)
+            try:
+                exp = read_from_tokens(tokens)
+            except IndexError:
+                raise SyntaxError('unexpected EOF in ' + self.file_name)
+            text = '\0'.join(source[start:len(source) - len(tokens)])
+            forms.append((sha1(_to_utf8(text)).digest(), exp))
+        old, self.forms = self.forms, {}
+        ours = set()            # names defined by the last load
+        for records in old.values():
+            for names, _ in records:
+                ours |= names
+        dirty = set()           # names evaluated again
+        n = 0
+        for digest, exp in forms:
+            kept = old.get(digest)
+            if kept and not (kept[0][1] & dirty):
+                record = kept.pop(0)
+            else:
+                mentions = _mentions(exp)
+                names = _evaluate_form(exp, ours)
+                if names is None: # Leave it to be evaluated next time.
+                    continue
+                record = (names, mentions)
+                dirty |= names
+                n += 1
+            self.forms.setdefault(digest, []).append(record)
+        return n, len(forms)
+
+    def run(self):
+        "Check the file at intervals and reload it when it has changed."
+        while True:
+            sleep(self.interval)
+            try:
+                if self.changed():
+                    with self.lock:
+                        n, total = self.reload()
+                    print('; %s: %d of %d forms evaluated' %
+                          (self.file_name, n, total), file=stderr)
+            except (IOError, OSError): # The file is being replaced.
+                pass
+            except SyntaxError as ex:
+                print(ex, file=stderr)
+
+def _mentions(exp):
+    "Return the set of the symbols in exp."
+    result, stack = set(), [exp]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, Cell):
+            stack.append(x.car)
+            stack.append(x.cdr)
+        elif isinstance(x, str):
+            result.add(x)
+    return frozenset(result)
+
+def _evaluate_form(exp, ours):
+    """Evaluate a top-level form and return the set of the names it defines,
+    or None if it fails.  (define v e) is done as (set! v e) if v is in ours.
+    """
+    names = set()
+    if (isinstance(exp, Cell) and exp.car is DEFINE_SYNTAX and
+        isinstance(exp.cdr, Cell)):
+        names.add(exp.cdr.car)
+    try:
+        expand(exp)
+        stack = [exp]
+        while stack:            # Look for (define v e) in (begin ...).
+            x = stack.pop()
+            if not isinstance(x, Cell):
+                continue
+            elif x.car is BEGIN:
+                j = x.cdr
+                while isinstance(j, Cell):
+                    stack.append(j.car)
+                    j = j.cdr
+            elif x.car is DEFINE and isinstance(x.cdr.car, str):
+                names.add(x.cdr.car)
+                if x.cdr.car in ours:
+                    x.car = SETQ
+        evaluate(exp)
+    except Exception as ex:
+        print(ex)
+        return None
+    return frozenset(names)
+
+def watch(file_name, repl=False):
+    """Load a script and evaluate its changed forms each time it changes.
+    If repl is true, run a session meanwhile.
+    """
+    watcher = Watcher(file_name)
+    watcher.reload()
+    if repl:
+        from threading import Thread
+        thread = Thread(target=watcher.run)
+        thread.daemon = True
+        thread.start()
+        read_eval_print_loop(watcher.lock)
+    else:
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+
+def _option(name, default):
+    "Remove '--name value' from argv and return value, or default if none."
+    if name not in argv:
+        return default
+    i = argv.index(name)
+    value = argv[i + 1]
+    del argv[i:i + 2]
+    return value
+
+# Batch runner: run_batch(files, jobs) runs scripts on a pool of worker
+# processes, each of which keeps a warm interpreter and runs each script
+# in a pristine copy of the top-level bindings and macros.
+
+_PRISTINE = []                  # [top-level env copy, macros] in a worker
+
+def _batch_init():
+    "Save the pristine state of a worker process."
+    _PRISTINE[:] = [_top_level_copy(), dict(MACROS)]
+
+def _run_script(file_name):
+    "Run a script in the pristine state and return a dict of the outcome."
+    env, macros = _PRISTINE
+    GLOBAL_ENV.next = _top_level_copy(env).next
+    MACROS.clear()
+    MACROS.update(macros)
+    out = StringIO()
+    status, error = 0, None
+    start = time()
+    PORTS.output = out
+    try:
+        load(file_name)
+    except Exception as ex:
+        status, error = 1, '%s: %s' % (type(ex).__name__, ex)
+    finally:
+        PORTS.output = None
+    return {'script': file_name, 'status': status, 'output': out.getvalue(),
+            'error': error, 'seconds': round(time() - start, 6)}
+
+def run_batch(files, jobs=1):
+    """Run scripts on jobs worker processes and return a report of them.
+    Each '@file' in files is a manifest listing scripts line by line.
+    """
+    from multiprocessing import Pool # Import it only when needed.
+    scripts = []
+    for f in files:
+        if f.startswith('@'):
+            with open(f[1:]) as rf:
+                scripts.extend(line.strip() for line in rf if line.strip())
+        else:
+            scripts.append(f)
+    start = time()
+    pool = Pool(jobs, _batch_init)
+    try:
+        results = pool.map(_run_script, scripts, 1)
+    finally:
+        pool.close()
+        pool.join()
+    return {'jobs': jobs, 'seconds': round(time() - start, 6),
+            'failed': sum(r['status'] for r in results), 'scripts': results}
+
+# Forkserver: run_forkserver(path) forks a child for each client of the
+# Unix domain socket path.  A client sends the length and the text of
+# its cwd and arguments joined with NULs, together with its standard
+# input, output and error (SCM_RIGHTS).  The child sends its pid, runs
+# the arguments as scm.py does with those files and sends its exit status
+# as a byte.  It needs Python 3 for sendmsg and recvmsg.
+
+_INT = Struct('<i')
+_HANDSHAKE_TIMEOUT = 1.0        # seconds to wait for a request
+
+def run_forkserver(path):
+    "Fork a child for each client connecting at the Unix domain socket path."
+    import signal
+    import socket
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # Reap children at exit.
+    if hasattr(gc, 'freeze'):   # Keep the objects out of GC to share pages.
+        gc.freeze()
+    print('Listening on', path, file=stderr)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            conn.settimeout(_HANDSHAKE_TIMEOUT) # Let no client stall us.
+            try:
+                fields, fds = _receive_args(conn)
+            except (socket.error, ValueError):
+                conn.close()
+                continue
+            conn.settimeout(None)
+            stderr.flush()
+            if os.fork() == 0:
+                listener.close()
+                _run_forked(conn, fields, fds)
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.remove(path)
+
+def _receive_args(conn):
+    "Receive [cwd, arg...] and the file descriptors from a client."
+    import socket
+    fds = array('i')
+    data, ancdata, _, _ = conn.recvmsg(4096,
+                                       socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, d in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(d[:len(d) - len(d) % fds.itemsize])
+    if len(fds) != 3 or len(data) < _INT.size:
+        for fd in fds:
+            os.close(fd)
+        raise ValueError('bad request')
+    n = _INT.unpack_from(data)[0] + _INT.size
+    try:
+        while len(data) < n:
+            d = conn.recv(n - len(data))
+            if not d:
+                raise ValueError('truncated request')
+            data += d
+    except (socket.error, ValueError):
+        for fd in fds:
+            os.close(fd)
+        raise
+    return data[_INT.size:n].decode('utf-8').split('\0'), list(fds)
+
+def _run_forked(conn, fields, fds):
+    "Run [cwd, arg...] in a forked child with fds as 0, 1 and 2, and exit."
+    import signal
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for i, fd in enumerate(fds):
+        os.dup2(fd, i)
+        os.close(fd)
+    use_batch_input()
+    status = 1
+    try:
+        conn.sendall(_INT.pack(os.getpid()))
+        os.chdir(fields[0])
+        args = fields[1:]
+        if args:
+            load(args[0])
+        if args[1:2] == ['-'] or not args:
+            read_eval_print_loop()
+        status = 0
+    except (Exception, KeyboardInterrupt) as ex:
+        print('%s: %s' % (type(ex).__name__, ex), file=stderr)
+    finally:
+        try:
+            stdout.flush()
+            stderr.flush()
+            conn.sendall(bytearray((status,)))
+        finally:
+            os._exit(status)
+
+def connect_forkserver(path, args):
+    """Run args on the forkserver at path with the standard input, output
+    and error of this process, and return the exit status.
+    """
+    import signal
+    import socket
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    data = '\0'.join([os.getcwd()] + list(args)).encode('utf-8')
+    conn.sendmsg([_INT.pack(len(data)) + data],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                   array('i', (0, 1, 2)).tobytes())])
+    data = b''
+    while True:
+        try:
+            d = conn.recv(16)
+            if not d:
+                return 1        # The child has died without the status.
+            data += d
+            if len(data) > _INT.size:
+                return bytearray(data)[_INT.size]
+        except KeyboardInterrupt: # Pass it to the child.
+            if len(data) >= _INT.size:
+                os.kill(_INT.unpack_from(data)[0], signal.SIGINT)
+
 if __name__ == '__main__':
-    if argv[1:2]:
+    if '--jit-stats' in argv:
+        argv.remove('--jit-stats')
+        atexit.register(lambda: print(jit_stats(), file=stderr))
+    if '--trace' in argv:
+        argv.remove('--trace')
+        set_hooks(Tracer())
+    if '--coverage' in argv:
+        argv.remove('--coverage')
+        coverage = Coverage()
+        set_hooks(coverage)
+        atexit.register(lambda: print(coverage.report(), file=stderr))
+    if '--batch' in argv:
+        argv.remove('--batch')
+        use_batch_input(True)
+    else:
+        use_batch_input()
+    if argv[1:2] == ['--serve']:
+        workers = int(_option('--workers', 4))
+        max_steps = int(_option('--max-steps', 1000000))
+        timeout = float(_option('--timeout', 10.0))
+        if argv[3:4]:
+            load(argv[3])
+        serve(argv[2], workers, max_steps, timeout)
+        exit(0)
+    elif argv[1:2] == ['--jobs']:
+        import json
+        report = run_batch(argv[3:], int(argv[2]))
+        print(json.dumps(report, indent=1, sort_keys=True))
+        exit(1 if report['failed'] else 0)
+    elif argv[1:2] == ['--forkserver']:
+        if argv[3:4]:
+            load(argv[3])
+        run_forkserver(argv[2])
+        exit(0)
+    elif argv[1:2] == ['--connect']:
+        exit(connect_forkserver(argv[2], argv[3:]))
+    elif argv[1:2] == ['--watch']:
+        watch(argv[2], argv[3:4] == ['-'])
+        exit(0)
+    elif argv[1:2] == ['--resume']:
+        resume(argv[2])
+        if argv[3:4] != ['-']:
+            exit(0)
+    elif argv[1:2]:
         load(argv[1])
         if argv[2:3] != ['-']:
             exit(0)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Checks for scm.py, runnable as ./test_scm.py or by pytest.
+They cover huge data, which must not overflow the Python stack, and
+regressions found so far.
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import warnings
+import scm
+
+DEEP = 100000                   # nesting depth of deep data
+LONG = 1000000                  # length of long lists
+PARAMS = 200000                 # number of parameters of a closure
+SCM_PY = os.path.splitext(os.path.abspath(scm.__file__))[0] + '.py'
+
+def run(source, budget=None):
+    "Evaluate the expressions in source and return the last value."
+    tokens, result = scm.split_string_into_tokens(source), None
+    while tokens:
+        result = scm.evaluate(scm.read_from_tokens(tokens), scm.GLOBAL_ENV,
+                              budget)
+    return result
+
+def fails(exception, source, budget=None):
+    "Run source and return the exception it raised, which must be raised."
+    try:
+        run(source, budget)
+    except exception as ex:
+        return ex
+    raise AssertionError('%s not raised: %s' % (exception.__name__, source))
+
+def test_deep_read_and_print():
+    source = '(' * DEEP + ')' * DEEP
+    exp = scm.read_from_tokens(scm.split_string_into_tokens(source))
+    assert scm.stringify(exp) == source
+    assert scm._equal(exp, scm.read_from_tokens(['('] * DEEP + [')'] * DEEP))
+
+def test_deep_improper_print():
+    source = '(0 . ' * DEEP + '0' + ')' * DEEP
+    exp = scm.read_from_tokens(scm.split_string_into_tokens(source))
+    assert scm.stringify(exp) == '(' + '0 ' * DEEP + '. 0)'
+
+def test_long_list():
+    numbers = ' '.join(str(i) for i in range(LONG))
+    exp = run("(define xs '(%s)) xs" % numbers)
+    assert scm.stringify(exp) == '(' + numbers + ')'
+    assert run('(fold (lambda (x n) (+ n 1)) 0 xs)') == LONG
+    assert run('(fold + 0 xs)') == LONG * (LONG - 1) // 2
+    assert run('(equal? xs (reverse (reverse xs)))') is True
+
+def test_many_parameters():
+    params = ' '.join('a%d' % i for i in range(PARAMS))
+    run('(define f (lambda (%s) (- a%d a0)))' % (params, PARAMS - 1))
+    run("(define ys '(%s))" % ' '.join(str(i) for i in range(PARAMS)))
+    assert run('(apply f ys)') == PARAMS - 1
+
+def test_let_macro():
+    assert run('(let ((x 1) (y 2)) (+ x y))') == 3
+    assert run("(let loop ((i 0) (a '())) (if (= i 3) a"
+               " (loop (+ i 1) (cons i a))))").car == 2
+
+def test_bytevector_equal():
+    assert run('(equal? (bytevector 1 2) (bytevector 1 2))') is True
+    assert run('(equal? (bytevector 1 2) (bytevector 1 3))') is False
+
+def test_shared_boxes():
+    run("""(define make-counter (lambda ()
+             (define n 0)
+             (define get (lambda () n))
+             (list (lambda () (set! n (+ n 1)) n) get)))
+           (define c1 (make-counter))
+           (define c2 (make-counter))""")
+    assert run('((car c1))') == 1 and run('((car c1))') == 2
+    assert run('((car (cdr c1)))') == 2 # The sibling shares the box.
+    assert run('((car c2))') == 1 and run('((car (cdr c2)))') == 1
+    run('(define add-to (lambda (x) (lambda (d) (set! x (+ x d)) x)))'
+        '(define a (add-to 10))')
+    assert run('(a 5)') == 15 and run('(a 5)') == 20
+    f = run('((lambda (unused-big) (define small 1) (lambda () small))'
+            ' (list 1 2 3))')
+    syms = [b.sym for b in f.env if isinstance(b, scm.Environment)]
+    assert 'small' in syms and 'unused-big' not in syms
+
+def test_budget_limits():
+    loop = '((lambda (f) (f f)) (lambda (f) (f f)))'
+    ex = fails(scm.ResourceError, loop, scm.Budget(max_steps=1000))
+    assert 'too many steps' in str(ex) and 1000 < ex.budget.steps < 1010
+    run('(define deep (lambda (n) (if (= n 0) 0 (+ 1 (deep (- n 1))))))')
+    ex = fails(scm.ResourceError, '(deep 100000)', scm.Budget(max_depth=1000))
+    assert 'continuation too deep' in str(ex)
+    assert ex.budget.peak_depth == 1001
+    start = scm.time()
+    ex = fails(scm.ResourceError, loop, scm.Budget(timeout=0.2))
+    assert 'deadline exceeded' in str(ex) and scm.time() - start < 2
+    budget = scm.Budget(1000000, 1000, 10)
+    assert run('(deep 100)', budget) == 100
+    assert budget.closures == 0 and budget.peak_depth > 300
+
+def test_budget_counts_cells():
+    for source, made in (("(cons 1 '())", 1), ("(append '(1 2) '(3))", 2),
+                         ("(reverse '(1 2 3))", 3), ("(list 1 2)", 0),
+                         ("(map (lambda (x) x) '(1 2 3))", 3),
+                         ("(fold cons '() '(1 2 3))", 3),
+                         ("(sort '(3 1 2) <)", 3)):
+        budget = scm.Budget()
+        run(source, budget)
+        assert budget.cells == budget.arg_cells + made, source
+
+def test_budget_stops_callbacks():
+    run('(define s (cons-stream 1 s)) (stream-cdr s)') # a cyclic stream
+    for source in ('(stream-fold + 0 s)', '(stream->list s)',
+                   '(apply stream-fold (list + 0 s))'):
+        ex = fails(scm.ResourceError, source, scm.Budget(max_steps=1000))
+        assert 'too many steps' in str(ex)
+        assert 1000 < ex.budget.steps < 1010
+        ex = fails(scm.ResourceError, source, scm.Budget(timeout=0.2))
+        assert 'deadline exceeded' in str(ex)
+    budget = scm.Budget()
+    run("(sort '(5 3 1 4 2) <)", budget)
+    assert budget.steps > 5     # Each comparison is a step.
+
+def test_escape_from_string_port():
+    s = run("""(with-output-to-string (lambda ()
+                 (call/cc (lambda (k)
+                            (with-output-to-string (lambda () (k 1)))))
+                 (display "kept")))""")
+    assert s.string == 'kept'
+    budget = scm.Budget()       # A loop of call/cc does not grow.
+    run("""(define cc-loop (lambda (n)
+             (if (= n 0) 0 (call/cc (lambda (k) (cc-loop (- n 1)))))))
+           (cc-loop 10000)""", budget)
+    assert budget.peak_depth < 20
+
+def test_checkpoint_and_resume():
+    import tempfile
+    script = """(define ints (lambda (n) (cons-stream n (ints (+ n 1)))))
+(define f (lambda (x) (if (= x 3) (if (checkpoint "cp") 300 3) x)))
+(display (map (lambda (x) (* 2 x))
+              (stream->list (stream-take 5 (stream-map f (ints 1))))))
+(display 'end)
+"""
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, 'cp.scm'), 'w') as f:
+        f.write(script)
+    def scheme(*args):
+        return subprocess.check_output((sys.executable, SCM_PY) + args,
+                                       cwd=directory).decode('utf-8')
+    try:
+        assert scheme('cp.scm') == '(2 4 6 8 10)end'
+        assert scheme('--resume', 'cp') == '(2 4 600 8 10)end'
+        assert scheme('--resume', 'cp') == '(2 4 600 8 10)end'
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+def test_batch_input():
+    chunks = iter(['(a', ' b)\n(c', '\n', ' d) x\n'])
+    reader = scm.Reader(lambda n: next(chunks, ''))
+    assert scm.stringify(reader.read()) == '(a b)'
+    assert scm.stringify(reader.read()) == '(c d)'
+    assert reader.read() == 'x' and isinstance(reader.read(), EOFError)
+    source = ('(display 1)\n(+ 2\n 3)\n(read)\n(a b\n c) "s"\n'
+              '(read-line)\nrest of line\n')
+    p = subprocess.Popen((sys.executable, SCM_PY), stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE)
+    out = p.communicate(source.encode('utf-8'))[0].decode('utf-8')
+    assert out == '15\n(a b c)\n"s"\n"rest of line"\n' # no prompts
+
+def with_hooks(hooks, source):
+    "Run source with hooks set."
+    scm.set_hooks(hooks)
+    try:
+        return run(source)
+    finally:
+        scm.set_hooks(None)
+
+def test_tracer():
+    run('(define fact (lambda (n) (if (= n 0) 1 (* n (fact (- n 1))))))'
+        '(define loop (lambda (n) (if (= n 0) (quote done) (loop (- n 1)))))')
+    out = scm.StringIO()
+    assert with_hooks(scm.Tracer(out), '(fact 2)') == 2
+    assert out.getvalue() == ('(fact 2)\n  (fact 1)\n    (fact 0)\n'
+                              '    => 1\n  => 1\n=> 2\n')
+    out = scm.StringIO()
+    with_hooks(scm.Tracer(out), '(loop 2)') # Tail calls do not nest.
+    assert out.getvalue() == '(loop 2)\n  (loop 1)\n  (loop 0)\n=> done\n'
+    out = scm.StringIO()
+    assert with_hooks(scm.Tracer(out, True),
+                      '(+ 1 (call/cc (lambda (k) (k 2))))') == 3
+    assert '#<continuation> 2\n' in out.getvalue()
+    assert out.getvalue().endswith('(+ 1 2)\n=> 3\n')
+
+def test_coverage():
+    c = scm.Coverage()
+    with_hooks(c, '(define never (lambda () (display "no")))')
+    assert with_hooks(c, '(if #t 1 (car 2))') == 1
+    assert c.report() == ('Coverage: 3 forms evaluated, 2 never evaluated\n'
+                          '  (display "no")\n  (car 2)')
+
+def test_fasl_round_trip():
+    x = run("""(define p (list 1 "str" 'sym))
+               (list p p (list 1 2 3) (* 99999999999 99999999999)
+                     -12345678901 2.5 (bytevector 0 255) '(a . b) #t '())""")
+    s = u'str\xe9' if bytes is not str else u'str\xe9'.encode('utf-8')
+    x.car.cdr.car.string = s
+    c = x.cdr.cdr.car
+    c.cdr.cdr.cdr = c                           # Make a cycle.
+    y = scm.fasl_loads(scm.fasl_dumps(x))
+    assert y.car is y.cdr.car                   # shared
+    assert y.car.cdr.car.string == s
+    c = y.cdr.cdr.car
+    assert c.cdr.cdr.cdr is c and c.cdr.car == 2
+    y, x = y.cdr.cdr.cdr, x.cdr.cdr.cdr
+    assert y.car == 99999999999 ** 2
+    assert scm.stringify(y) == scm.stringify(x)
+    strs = run('(list %s)' % ' '.join(['"abc"'] * 1000))
+    assert len(scm.fasl_dumps(strs)) < len(scm.stringify(strs))
+
+def compile_hot(name, args):
+    "Call the closure bound to name often enough to compile it."
+    for _ in range(scm.JIT_THRESHOLD + 1):
+        run('(%s %s)' % (name, args))
+
+def jit_entry(name):
+    "Return the last entry of JIT_STATS for the closure bound to name."
+    info = run(name).info
+    return [e for e in scm.JIT_STATS if e[1] is info][-1]
+
+def test_jit_matches_interpreter():
+    run("""(define jit-f (lambda (n xs)
+             (if (null? xs) (list n (eq? n 1000) (eq? 'a 'a) (< n 7))
+                 (jit-f (+ n (car xs)) (cdr xs)))))""")
+    args = ["0 '()", "1 '(2 3)", "990 '(4 6)", "-5 '(1 2 3 4)"]
+    threshold = scm.JIT_THRESHOLD
+    scm.JIT_THRESHOLD = 0
+    try:
+        expected = [scm.stringify(run('(jit-f %s)' % a)) for a in args]
+    finally:
+        scm.JIT_THRESHOLD = threshold
+    with warnings.catch_warnings():
+        warnings.simplefilter('error') # No "is" with a literal may warn.
+        compile_hot('jit-f', args[1])
+    assert jit_entry('jit-f')[2] == 'compiled'
+    assert [scm.stringify(run('(jit-f %s)' % a)) for a in args] == expected
+
+def test_jit_guard_falls_back():
+    run('(define jit-g (lambda (a b) (+ a b))) (define saved+ +)')
+    compile_hot('jit-g', '1 2')
+    assert jit_entry('jit-g')[2] == 'compiled'
+    try:
+        run('(define + -)')
+        assert run('(jit-g 5 3)') == 2
+        assert jit_entry('jit-g')[2] == 'fell back'
+    finally:
+        run('(define + saved+)')
+    assert run('(jit-g 5 3)') == 8
+
+def test_jit_deep_recursion_falls_back():
+    run('(define jit-sum (lambda (n) (if (= n 0) 0 (+ n (jit-sum (- n 1))))))')
+    compile_hot('jit-sum', '10')
+    assert jit_entry('jit-sum')[2] == 'compiled'
+    assert run('(jit-sum %d)' % DEEP) == DEEP * (DEEP + 1) // 2
+    assert jit_entry('jit-sum')[2] == 'fell back'
+
+def test_jit_self_tail_loop():
+    run('(define jit-n (lambda (n a) (if (= n 0) a (jit-n (- n 1) (+ a 1)))))')
+    compile_hot('jit-n', '1 0')
+    entry = jit_entry('jit-n')
+    calls = entry[3]
+    assert run('(jit-n %d 0)' % LONG) == LONG
+    assert entry[2] == 'compiled' and entry[3] == calls + 1 # one loop
+
+def test_server_loopback():
+    import socket, threading
+    threads = threading.active_count()
+    server = scm.ReplServer(('127.0.0.1', 0), max_steps=10000)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = socket.create_connection(server.address)
+    rfile = client.makefile('rb')
+    def request(text):
+        "Send text and return the lines of the response before '.'."
+        client.sendall(text.encode('utf-8'))
+        lines = []
+        while True:
+            line = rfile.readline().decode('utf-8').rstrip('\n')
+            if line == '.':
+                return lines
+            lines.append(line[1:] if line.startswith('..') else line)
+    try:
+        assert request('(define x 5)\n') == []
+        assert request('(display "hi")\n') == ['hi']
+        assert request('(begin (display ".a") (+ x 1))\n') == ['.a', '6']
+        assert request('(read-line)\nabc def\n') == ['"abc def"']
+        assert request('(let* ((a (peek-char)) (b (read-char))'
+                       ' (c (read-char))) (list a b c))\nxy') == [
+                           '("x" "x" "y")']
+        assert request('(read)\n(1 2)\n') == ['(1 2)']
+        assert request('(car 1)\n')[0].startswith('AttributeError')
+        assert 'too many steps' in request('((lambda (f) (f f))'
+                                           ' (lambda (f) (f f)))\n')[0]
+        assert request(':stats\n')[0].startswith('{')
+    finally:
+        rfile.close()
+        client.close()
+        for _ in range(500):    # Wait for the thread of the session to end.
+            if threading.active_count() <= threads + 1:
+                break
+            scm.sleep(0.01)
+        server.shutdown()
+        server.close()
+        thread.join()
+
+if __name__ == '__main__':
+    for name, fun in sorted(globals().items()):
+        if name.startswith('test_'):
+            fun()
+            print('ok', name)